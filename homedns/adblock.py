@@ -3,20 +3,138 @@
 
 # generate domain list from adblock rules.
 
+import re
+import sys
+import functools
 import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 
 logger = logging.getLogger(__name__)
 
+# update in background, no more than 2 downloads at same time
+_update_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='adblock-update')
+
+# cached isBlock results for each rule
+BLOCK_CACHE_SIZE = 4096
+
+# one rule each line:
+#   skip comment, "! comment" and "[Adblock Plus 2.0]"
+#   "@@" for white list
+#   remove "||" and "|"
+#   remove protocols, http://
+#   drop url, /url, but keep "example.com/"
+RULE_RE = re.compile(
+    r'^[^\S\n]*(?![!\[])(@@)?\|*(?:[^\s/]*://)?([^\s/]+)/?[^\S\n]*$',
+    re.MULTILINE,
+)
+
+
+class DomainTrie(object):
+    """
+    reversed-label trie, ".www.example.com" => com -> example -> www
+    node: {label: child_node, None: levels}
+    levels: one level for each domain list stored in trie
+
+    compact() collapses unary chains into radix edges and resolves levels:
+    node: {first_label: (rest_labels, child_node), None: (levels, full)}
+    rest_labels: in host order, com -> (www, example)
+    levels: inherited from parent domain for every domain list
+    full: levels when host fully matches the node
+    """
+    def __init__(self, size=1):
+        self.root = {}
+        self.size = size
+        self.compacted = False
+
+    def insert(self, labels, level, index=0):
+        assert not self.compacted, 'Could not insert into compacted trie'
+        node = self.root
+        for label in labels:
+            child = node.get(label)
+            if child is None:
+                # share one string object for same label, "com", "google"
+                child = node[sys.intern(label)] = {}
+            node = child
+        levels = node.get(None)
+        if levels is None:
+            levels = node[None] = [0] * self.size
+        levels[index] = level
+
+    def compact(self):
+        self._empty = (0,) * self.size
+        self.root = self._compact(self.root, self._empty)
+        self.compacted = True
+        # only "*" or nothing in trie, every host has the same levels
+        terminal = self.root.get(None)
+        self.wildcard = None
+        if len(self.root) == (1 if terminal else 0):
+            self.wildcard = terminal[0] if terminal else self._empty
+
+    def _compact(self, node, inherited):
+        radix = {}
+        own = node.get(None)
+        if own:
+            inherited = tuple(
+                level or parent for level, parent in zip(own, inherited)
+            )
+            full = tuple(
+                100 if level else parent for level, parent in zip(own, inherited)
+            )
+            radix[None] = (inherited, full)
+        for label, child in node.items():
+            if label is None:
+                continue
+            rest = []
+            # merge child until it is terminal or has branches
+            while len(child) == 1 and None not in child:
+                (next_label, child), = child.items()
+                rest.append(next_label)
+            radix[label] = (tuple(rest[::-1]), self._compact(child, inherited))
+        return radix
+
+    def match(self, labels):
+        """
+        labels: host labels, ('www', 'example', 'com'), walk from last one
+        return level of the longest matched domain for every domain list,
+        100 for full match
+        """
+        if not self.compacted:
+            self.compact()
+        node = self.root
+        terminal = node.get(None)
+        levels = terminal[0] if terminal else self._empty
+        pos = len(labels)
+        while pos:
+            pos -= 1
+            edge = node.get(labels[pos])
+            if edge is None:
+                return levels
+            rest, node = edge
+            if rest:
+                start = pos - len(rest)
+                if start < 0 or labels[start:pos] != rest:
+                    return levels
+                pos = start
+            terminal = node.get(None)
+            if terminal:
+                levels = terminal[0]
+        if terminal and node is not self.root:
+            return terminal[1]
+        return levels
+
 
 class Adblock(object):
     def __init__(self, name):
         self.name = name
         self.loader = None
-        self.updating = False
+        self._update_lock = threading.Lock()
         self.blacklist = set()
         self.whitelist = set()
+        self._trie = DomainTrie(2)
+        self._trie.compact()
+        self._reset_cache()
 
     def __repr__(self):
         return '<Adblock: %s>' % self.name
@@ -25,100 +143,118 @@ class Adblock(object):
         return bool(self.blacklist)
 
     def isNeedUpdate(self, refresh):
-        if self.updating or refresh == 0:
+        if self._update_lock.locked() or refresh == 0:
             return False
         if not self.blacklist:
             return True
         return self.loader.isNeedUpdate(refresh)
 
-    def async_update(self, loader=None):
-        # XXX: resource Lock?
-        t = threading.Thread(
-            target=self.update,
-            kwargs={
-                'loader': loader,
-                'cache': False,
-            }
-        )
-        t.start()
+    def async_update(self, loader=None, cache=False):
+        # only one update at same time, skip if updating
+        if not self._update_lock.acquire(blocking=False):
+            return
+
+        def locked_update():
+            try:
+                self._update(loader=loader, cache=cache)
+            finally:
+                self._update_lock.release()
+        try:
+            _update_pool.submit(locked_update)
+        except Exception:
+            self._update_lock.release()
+            raise
 
     def update(self, loader=None, cache=True):
+        with self._update_lock:
+            self._update(loader=loader, cache=cache)
+
+    def _update(self, loader=None, cache=True):
         if not loader:
             loader = self.loader
-        self.updating = True
         logger.warn('Update rules %s', loader)
-        self.blacklist = set()
-        self.whitelist = set()
         self.create(loader, cache=cache)
-        self.updating = False
 
     def create(self, loader, cache=True):
         self.loader = loader
+        blacklist = set()
+        whitelist = set()
         try:
             line = None
-            loader_io = loader.open(cache=cache)
-            for line in iter(loader_io.readline, ''):
-                line = line.strip()
-                if not line or line[0] in ('!', '['):
-                    continue
+            # only add lower character
+            with loader.open(cache=cache) as f:
+                text = f.read().lower()
+            for white, line in RULE_RE.findall(text):
                 # @@ white list
-                if line.startswith('@@'):
-                    domain_list = self.whitelist
-                    line = line.lstrip('@@')
-                else:
-                    domain_list = self.blacklist
-                # remove protocols, http://
-                line = line.rpartition('://')[2]
-                # remove url, /url, /^
-                url = line.partition('/')
-                if url[2]:
+                domain_list = whitelist if white else blacklist
+                dot = line.rfind('.')
+                # non-domain
+                if dot < 0:
                     continue
-                line = url[0]
                 # drop IP address, 1.1.1.1
-                if line.rpartition('.')[2].isdigit():
-                    continue
-                # non-domain
-                if '.' not in line:
+                if line[dot + 1:].isdigit():
                     continue
                 # remove *
-                lp = line.partition('*')
-                line = lp[0] if '.' in lp[0] else lp[2]
-                # remove ||
-                for ch in ('||'):
-                    line = line.lstrip(ch)
+                if '*' in line:
+                    lp = line.partition('*')
+                    line = lp[0] if '.' in lp[0] else lp[2]
                 # add '.' to match every item in domain
                 if line[0] != '.':
                     line = '.' + line
-                # only add lower character
-                domain_list.add(line.lower())
+                domain_list.add(line)
         except Exception as err:
             logger.error('Load %s error: %s with "%s"' % (self, err, line))
             return
+        # match black and white list in one pass
+        trie = DomainTrie(2)
+        for index, domain_list in enumerate((blacklist, whitelist)):
+            for domain in domain_list:
+                if domain == '.*':
+                    # www.example.com == .*
+                    trie.insert([], 1, index)
+                else:
+                    # www.example.com == .example.com
+                    #    ^^^^^^^^^^^^
+                    trie.insert(domain[1:].split('.')[::-1], len(domain), index)
+        trie.compact()
+        self._trie = trie
+        self.blacklist = blacklist
+        self.whitelist = whitelist
+        # drop results of old rules
+        self._reset_cache()
+
+    def _reset_cache(self):
+        self._isBlock = functools.lru_cache(maxsize=BLOCK_CACHE_SIZE)(
+            self._match_block
+        )
+
+    def _inList(self, host):
+        """ return (black level, white level) """
+        trie = self._trie
+        if trie.wildcard is not None:
+            return trie.wildcard
+        if isinstance(host, str):
+            host = tuple(host.split('.'))
+        return trie.match(host)
 
-    def _inList(self, domain_list, host):
-        level = 0
-        for domain in domain_list:
-            if domain == '.*':
-                # www.example.com == .*
-                level = 1
-            elif host[-len(domain):] == domain:
-                # www.example.com == .example.com
-                #    ^^^^^^^^^^^^
-                level = len(domain)
-            elif '.' + host == domain:
-                # sub.example.com == .sub.example.com
-                # full match
-                level = 100
-        return level
+    def _match_block(self, labels):
+        trie = self._trie
+        black, white = trie.wildcard or trie.match(labels)
+        return black > white
 
     def isBlock(self, host):
-        return self.isBlack(host) > self.isWhite(host)
+        """
+        host: "www.example.com" or lower case labels ('www', 'example', 'com')
+        """
+        if isinstance(host, str):
+            host = tuple(host.split('.'))
+        return self._isBlock(host)
 
     def isWhite(self, host):
-        return self._inList(self.whitelist, host)
+        return self._inList(host)[1]
 
     def isBlack(self, host):
-        return self._inList(self.blacklist, host)
+        return self._inList(host)[0]
 
     def output_list(self):
         line = []
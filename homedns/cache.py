@@ -2,6 +2,8 @@
 
 import os
 import time
+import threading
+from collections import OrderedDict
 
 
 class Cache(object):
@@ -13,31 +15,47 @@ class FileCache(Cache):
 
 
 class MemoryCache(Cache):
-    _mobj = {}
+    """
+    LRU cache, drop the least recently used item when full
+    """
+    _maxsize = 4096
+    _mobj = OrderedDict()
+    _lock = threading.Lock()
 
     @classmethod
-    def add(cls, key, value):
-        cls._mobj[key] = {
-            'value': value,
-            'time': time.time(),
-        }
+    def add(cls, key, value, timeout=None):
+        """ timeout: seconds, default is Cache._timeout """
+        if timeout is None:
+            timeout = cls._timeout
+        with cls._lock:
+            cls._mobj[key] = {
+                'value': value,
+                'expire': time.monotonic() + timeout,
+            }
+            cls._mobj.move_to_end(key)
+            while len(cls._mobj) > cls._maxsize:
+                cls._mobj.popitem(last=False)
 
     @classmethod
     def delete(cls, key):
-        del cls._mobj[key]
+        with cls._lock:
+            cls._mobj.pop(key, None)
 
     @classmethod
     def clear(cls):
-        cls._mobj = {}
+        with cls._lock:
+            cls._mobj.clear()
 
     @classmethod
     def get(cls, key):
-        data = cls._mobj.get(key)
-        if data:
-            if (time.time() - data['time']) > cls._timeout:
-                cls.delete(key)
-            else:
-                return data['value']
+        with cls._lock:
+            data = cls._mobj.get(key)
+            if data:
+                if time.monotonic() > data['expire']:
+                    del cls._mobj[key]
+                else:
+                    cls._mobj.move_to_end(key)
+                    return data['value']
 
 
 class DNSCache(MemoryCache):
@@ -1,31 +1,47 @@
 import logging
-import binascii
 import struct
 import socket
+import secrets
+import threading
+import time
 import traceback
+import queue
 
 import dnslib
 from dnslib import RR, QTYPE, DNSRecord
+from dnslib.label import DNSBuffer
 import socks
 
 from . import globalvars
 
 logger = logging.getLogger(__name__)
 
+_upstreams_lock = threading.Lock()
+# shared UDP sockets, {(inet, dest, port): UDPUpstream}
+_udp_upstreams = {}
+# persistent TCP connections, {(inet, dest, port, proxy): TCPUpstream}
+_tcp_upstreams = {}
+# sockets of each UDP upstream, query is sent from random one of them
+UDP_SOCKETS = 4
+# queries sent from one UDP socket before it is replaced by new source port
+UDP_SOCKET_QUERIES = 64
 
-def lookup_upstream(request, reply, server, proxy):
+
+def lookup_upstream(request, reply, server, proxy, data=None):
     """
     use TCP mode when proxy enable
+    data: raw request message, forward it without packing request again
     """
     try:
-        message = '\tForward to server %(ip)s:%(port)s(%(priority)s)' % server
-        message += ' with %s mode' % ('TCP' if server['tcp'] else 'UDP')
-        if server['proxy'] and proxy:
+        if logger.isEnabledFor(logging.INFO):
+            message = '\tForward to server %(ip)s:%(port)s(%(priority)s)' % server
+            message += ' with %s mode' % ('TCP' if server['tcp'] else 'UDP')
+            if server['proxy'] and proxy:
                 message += ' and proxy %(type)s://%(ip)s:%(port)s' % proxy
-        logger.info(message)
+            logger.info(message)
 
         data = sendto_upstream(
-            request.pack(),
+            data or request.pack(),
             server['ip'],
             server['port'],
             tcp=server['tcp'],
@@ -35,16 +51,16 @@ def lookup_upstream(request, reply, server, proxy):
         try:
             upstream_reply = DNSRecord.parse(data)
         except Exception as err:
-            logger.error('Parse request error: %s %s %s' % (
-                err, len(data), binascii.b2a_hex(data)))
+            logger.error('Parse request error: %s %s %s', err, len(data), data.hex())
             return True
         if upstream_reply.rr:
+            bogus_nxdomain = globalvars.bogus_nxdomain
+            hack_ip = globalvars.config['smartdns']['bogus_nxdomain']['hack_ip']
             for r in upstream_reply.rr:
                 rqn = r.rname
                 rqt = QTYPE[r.rtype]
-                if rqt in ['A', 'AAAA'] and str(r.rdata) in globalvars.bogus_nxdomain:
-                    logger.warn('\t*** Bogus Answer: %s(%s) ***' % (r.rdata, rqt))
-                    hack_ip = globalvars.config['smartdns']['bogus_nxdomain']['hack_ip']
+                if rqt in ['A', 'AAAA'] and str(r.rdata) in bogus_nxdomain:
+                    logger.warning('\t*** Bogus Answer: %s(%s) ***', r.rdata, rqt)
                     if hack_ip:
                         hack_rqt = 'AAAA' if ':' in hack_ip else 'A'
                         hack_r = RR(
@@ -58,13 +74,13 @@ def lookup_upstream(request, reply, server, proxy):
                     reply.add_answer(r)
         message = ['\tReturn from %(ip)s:%(port)s(%(priority)s):' % server]
         if globalvars.dig:
-            logger.warn(str(reply))
+            logger.warning('%s', reply)
         elif reply.rr:
             for r in reply.rr:
                 message.append('\t\t%s(%s)' % (r.rdata, QTYPE[r.rtype]))
         else:
             message.append('\t\tN/A')
-        logger.warn('\n'.join(message))
+        logger.warning('\n'.join(message))
         return True
     except socket.error as err:
         frm = '%(ip)s:%(port)s(%(priority)s)' % server
@@ -79,6 +95,397 @@ def lookup_upstream(request, reply, server, proxy):
     return False
 
 
+class NoCompressBuffer(DNSBuffer):
+    """
+        Encode name without compression pointer,
+        so packed record could be copied into any message
+    """
+    def encode_name(self, name):
+        self.encode_name_nocompress(name)
+
+
+# compression pointer to name of the only question, just after header
+QNAME_POINTER = b'\xc0\x0c'
+
+
+def pack_rr(rr):
+    """
+        return (owner, rest), owner: lower case of owner name in wire format,
+        rest: type, class, ttl and rdata after owner name
+    """
+    buf = NoCompressBuffer()
+    buf.encode_name(rr.rname)
+    size = len(buf.data)
+    rr.pack(buf)
+    data = bytes(buf.data[size:])
+    return data[:size].lower(), data[size:]
+
+
+def pack_reply(header, question, answers):
+    """
+        Pack reply from packed parts without building DNSRecord
+        header: DNSHeader of reply
+        question: question in wire format, copied from request
+        answers: list of packed answers, see pack_rr
+        owner name same as question is written as compression pointer
+    """
+    buf = bytearray(12)
+    struct.pack_into(
+        '!HHHHHH', buf, 0,
+        header.id, header.bitmap, 1, len(answers), 0, 0,
+    )
+    buf += question
+    qname = bytes(question[:-4]).lower()
+    for owner, rest in answers:
+        buf += QNAME_POINTER if owner == qname else owner
+        buf += rest
+    return buf
+
+
+def parse_question(data):
+    """
+        Parse header and the first question of DNS message only
+        return (id, qname, qtype, qclass, end of question)
+        qname: lower case of name in wire format, b'\\x03www\\x07example\\x03com\\x00'
+    """
+    txid, flags, qdcount = struct.unpack_from('!HHH', data)
+    if qdcount != 1:
+        raise ValueError('Only support one question: %s' % qdcount)
+    pos = 12
+    length = data[pos]
+    while length:
+        if length & 0xC0:
+            raise ValueError('Compressed name in question')
+        pos += length + 1
+        length = data[pos]
+    pos += 1
+    qtype, qclass = struct.unpack_from('!HH', data, pos)
+    return txid, bytes(data[12:pos]).lower(), qtype, qclass, pos + 4
+
+
+def skip_name(data, pos):
+    """ return end of name in wire format at pos """
+    length = data[pos]
+    while length:
+        if length & 0xC0:
+            # compression pointer ends the name
+            return pos + 2
+        pos += length + 1
+        length = data[pos]
+    return pos + 1
+
+
+def ttl_offsets(data, pos):
+    """
+        Offsets of TTL field of all records in DNS message
+        pos: end of question, see parse_question
+        OPT record is skipped, its TTL field is extended RCODE and flags
+    """
+    offsets = []
+    count = sum(struct.unpack_from('!HHH', data, 6))
+    for i in range(count):
+        pos = skip_name(data, pos)
+        rtype, rclass, ttl, rdlength = struct.unpack_from('!HHIH', data, pos)
+        if rtype != QTYPE.OPT:
+            offsets.append(pos + 4)
+        pos += 10 + rdlength
+    return offsets
+
+
+def recvall(sock, size, buf=None):
+    """
+        Receive exactly size bytes from stream socket
+        return the receiving bytearray without copying it into bytes
+        buf: preallocated bytearray reused by caller, filled from start
+    """
+    if buf is None:
+        buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = sock.recv_into(view[pos:], size - pos)
+        if not n:
+            raise ConnectionError('Connection closed by peer')
+        pos += n
+    return buf
+
+
+class UDPUpstream(object):
+    """
+        A few connected UDP sockets for upstream server.
+        Query is sent from random socket with an unique random ID and the
+        response is dispatched by reader thread of the socket, so many
+        queries share the sockets at same time.
+        Socket is replaced by a new one with another random source port
+        after UDP_SOCKET_QUERIES queries, and closed after its last response.
+        Response is accepted only if its question is same as the query.
+    """
+    def __init__(self, dest, port, inet=socket.AF_INET, count=UDP_SOCKETS):
+        self.address = (dest, port)
+        self.inet = inet
+        # {txid: (Queue, sock, question)}
+        self._pending = {}
+        # {sock: [sent queries, waiting queries]} of open sockets
+        self._usage = {}
+        self._lock = threading.Lock()
+        with self._lock:
+            self.socks = [self._open() for index in range(count)]
+
+    def _open(self):
+        """ called with lock """
+        sock = socket.socket(self.inet, socket.SOCK_DGRAM)
+        # only receive from upstream server, source port is random
+        sock.connect(self.address)
+        self._usage[sock] = [0, 0]
+        t = threading.Thread(
+            target=self._read,
+            args=(sock,),
+            name='upstream-%s:%s' % self.address,
+        )
+        t.daemon = True
+        t.start()
+        return sock
+
+    def _close(self, sock):
+        """ called with lock, reader closes the socket when it wakes up """
+        del self._usage[sock]
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def query(self, data, timeout=None):
+        waiter = queue.Queue(1)
+        try:
+            question = parse_question(data)[1:4]
+        except Exception:
+            # dnslib accepts it, match response by ID only
+            question = None
+        with self._lock:
+            index = secrets.randbelow(len(self.socks))
+            sock = self.socks[index]
+            usage = self._usage[sock]
+            usage[0] += 1
+            if usage[0] >= UDP_SOCKET_QUERIES:
+                # retire it, later queries use new source port
+                self.socks[index] = self._open()
+            usage[1] += 1
+            txid = secrets.randbits(16)
+            while txid in self._pending:
+                txid = secrets.randbits(16)
+            self._pending[txid] = (waiter, sock, question)
+        try:
+            sock.send(struct.pack('!H', txid) + data[2:])
+            response = waiter.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout('timed out')
+        finally:
+            with self._lock:
+                del self._pending[txid]
+                usage[1] -= 1
+                if not usage[1] and sock not in self.socks:
+                    self._close(sock)
+        # restore ID of query
+        return bytes(data[:2]) + response[2:]
+
+    def _read(self, sock):
+        # receive into one buffer, copy out the response of pending query only
+        buf = bytearray(65535)
+        view = memoryview(buf)
+        while True:
+            try:
+                size = sock.recv_into(buf)
+            except OSError as err:
+                if sock.fileno() < 0:
+                    return
+                # ICMP port unreachable, query will be timeout
+                logger.debug('Receive from upstream error: %s' % err)
+                continue
+            if not size:
+                with self._lock:
+                    retired = sock not in self._usage
+                if retired:
+                    sock.close()
+                    return
+            if size < 12:
+                continue
+            with self._lock:
+                pending = self._pending.get(struct.unpack_from('!H', buf)[0])
+            if pending is None:
+                continue
+            waiter, query_sock, question = pending
+            try:
+                valid = query_sock is sock and (
+                    question is None or
+                    parse_question(view[:size])[1:4] == question
+                )
+            except Exception:
+                valid = False
+            if not valid:
+                logger.warning('Drop mismatched response from upstream: %s',
+                               sock.getpeername())
+                continue
+            try:
+                waiter.put_nowait(bytes(view[:size]))
+            except queue.Full:
+                # duplicated response
+                pass
+
+
+def get_udp_upstream(dest, port, inet=socket.AF_INET):
+    key = (inet, dest, port)
+    with _upstreams_lock:
+        upstream = _udp_upstreams.get(key)
+        if upstream is None:
+            upstream = _udp_upstreams[key] = UDPUpstream(dest, port, inet)
+    return upstream
+
+
+def create_sock(inet, tcp, proxy=None):
+    stype = socket.SOCK_STREAM if tcp else socket.SOCK_DGRAM
+    if tcp and proxy:
+        sock = socks.socksocket(inet, stype)
+        sock.set_proxy(
+            socks.PROXY_TYPES[proxy['type'].upper()],
+            proxy['ip'],
+            proxy['port'],
+        )
+    else:
+        sock = socket.socket(inet, stype)
+    return sock
+
+
+class TCPUpstream(object):
+    """
+        Persistent TCP connection (through proxy) for upstream server.
+        Queries are pipelined with unique ID (RFC 7766) and the responses
+        are dispatched by reader thread of the connection.
+        Connection is dropped on timeout only if nothing is received since
+        the oldest waiting query was sent.
+    """
+    def __init__(self, dest, port, inet=socket.AF_INET, proxy=None):
+        self.address = (dest, port)
+        self.inet = inet
+        self.proxy = proxy
+        self.sock = None
+        # {txid: (Queue, sent time)} of current connection
+        self._pending = {}
+        # [last received time] of current connection
+        self._received = [0]
+        self._lock = threading.Lock()
+
+    def _connect(self, timeout):
+        """ called with lock """
+        sock = create_sock(self.inet, True, self.proxy)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(self.address)
+        except Exception:
+            sock.close()
+            raise
+        # keep timeout, sending with lock held must not block forever
+        self.sock = sock
+        self._pending = {}
+        self._received = [time.monotonic()]
+        t = threading.Thread(
+            target=self._read,
+            args=(sock, self._pending, self._received),
+            name='upstream-%s:%s' % self.address,
+        )
+        t.daemon = True
+        t.start()
+
+    def _drop(self, sock, pending):
+        """ called with lock, wake up queries waiting on closed connection """
+        if self.sock is sock:
+            self.sock = None
+        sock.close()
+        for waiter, sent in pending.values():
+            try:
+                waiter.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def query(self, data, timeout=None):
+        if len(data) > 65535:
+            raise ValueError("Packet length too long: %d" % len(data))
+        # connect again once if connection is closed by server
+        for retry in range(2):
+            waiter = queue.Queue(1)
+            with self._lock:
+                if self.sock is None:
+                    self._connect(timeout)
+                sock, pending = self.sock, self._pending
+                received = self._received
+                txid = secrets.randbits(16)
+                while txid in pending:
+                    txid = secrets.randbits(16)
+                pending[txid] = (waiter, time.monotonic())
+                try:
+                    sock.sendall(struct.pack('!HH', len(data), txid) + data[2:])
+                except OSError as err:
+                    logger.debug('Send to upstream error: %s' % err)
+                    self._drop(sock, pending)
+            try:
+                response = waiter.get(timeout=timeout)
+            except queue.Empty:
+                with self._lock:
+                    oldest = min(sent for waiter, sent in pending.values())
+                    if received[0] < oldest:
+                        # connection may be dropped silently by proxy or NAT
+                        self._drop(sock, pending)
+                raise socket.timeout('timed out')
+            finally:
+                pending.pop(txid, None)
+            if response is not None:
+                # restore ID of query
+                return bytes(data[:2]) + response[2:]
+        raise ConnectionError('Connection closed by upstream')
+
+    def _read(self, sock, pending, received):
+        header = bytearray(2)
+        try:
+            while True:
+                try:
+                    size = sock.recv_into(header, 2)
+                except socket.timeout:
+                    # idle connection
+                    continue
+                if not size:
+                    raise ConnectionError('Connection closed by peer')
+                if size == 1:
+                    recvall(sock, 1, memoryview(header)[1:])
+                length = struct.unpack('!H', header)[0]
+                # stalled in the middle of message, drop connection
+                response = recvall(sock, length)
+                received[0] = time.monotonic()
+                if length < 12:
+                    continue
+                waiter, sent = pending.get(
+                    struct.unpack_from('!H', response)[0], (None, None)
+                )
+                if waiter:
+                    try:
+                        waiter.put_nowait(response)
+                    except queue.Full:
+                        pass
+        except OSError as err:
+            logger.debug('Receive from upstream error: %s' % err)
+        with self._lock:
+            self._drop(sock, pending)
+
+
+def get_tcp_upstream(dest, port, inet=socket.AF_INET, proxy=None):
+    key = (inet, dest, port, proxy and (
+        proxy['type'], proxy['ip'], proxy['port']
+    ))
+    with _upstreams_lock:
+        upstream = _tcp_upstreams.get(key)
+        if upstream is None:
+            upstream = _tcp_upstreams[key] = TCPUpstream(dest, port, inet, proxy)
+    return upstream
+
+
 def sendto_upstream(data, dest, port=53,
                     tcp=False, timeout=None, ipv6=False,
                     proxy=None):
@@ -87,45 +494,16 @@ def sendto_upstream(data, dest, port=53,
         proxy_type: SOCKS5, SOCKS4, HTTP
 
         Note:: many proxy server only support TCP mode.
+        Note:: TCP connection is kept alive and pipelined (RFC 7766),
+               UDP socket is shared
     """
-    def get_sock(inet, tcp, proxy=None):
-        stype = socket.SOCK_STREAM if tcp else socket.SOCK_DGRAM
-        if tcp and proxy:
-            sock = socks.socksocket(inet, stype)
-            sock.set_proxy(
-                socks.PROXY_TYPES[proxy['type'].upper()],
-                proxy['ip'],
-                proxy['port'],
-            )
-        else:
-            sock = socket.socket(inet, stype)
-        return sock
-
     if ipv6:
         inet = socket.AF_INET6
     else:
         inet = socket.AF_INET
 
-    sock = get_sock(inet, tcp, proxy)
     if tcp:
-        if len(data) > 65535:
-            raise ValueError("Packet length too long: %d" % len(data))
-        data = struct.pack("!H", len(data)) + data
-        if timeout is not None:
-            sock.settimeout(timeout)
-        sock.connect((dest, port))
-        sock.sendall(data)
-        response = sock.recv(8192)
-        if response:
-            length = struct.unpack("!H", bytes(response[:2]))[0]
-            while len(response) - 2 < length:
-                response += sock.recv(8192)
-            response = response[2:]
-        sock.close()
+        upstream = get_tcp_upstream(dest, port, inet, proxy)
     else:
-        if timeout is not None:
-            sock.settimeout(timeout)
-        sock.sendto(data, (dest, port))
-        response, server = sock.recvfrom(8192)
-        sock.close()
-    return response
+        upstream = get_udp_upstream(dest, port, inet)
+    return upstream.query(data, timeout)
@@ -77,16 +77,18 @@ def dict2RR(r):
     return answer
 
 
-def lookup_upstream(request, reply, server, proxy):
+def lookup_upstream(request, reply, server, proxy, data=None):
     """
     json-format: https://developers.cloudflare.com/1.1.1.1/dns-over-https/json-format/
+    data: raw request message, forward it without packing request again
     """
     try:
-        message = '\tForward to server %(ip)s(%(priority)s)' % server
-        message += ' with %s protocol' % server['protocol']
-        if server['proxy'] and proxy:
-            message += ' and proxy %(type)s://%(ip)s:%(port)s' % proxy
-        logger.info(message)
+        if logger.isEnabledFor(logging.INFO):
+            message = '\tForward to server %(ip)s(%(priority)s)' % server
+            message += ' with %s protocol' % server['protocol']
+            if server['proxy'] and proxy:
+                message += ' and proxy %(type)s://%(ip)s:%(port)s' % proxy
+            logger.info(message)
 
         if server['protocol'] == 'doh_json':
             qn = request.q.qname
@@ -113,17 +115,18 @@ def lookup_upstream(request, reply, server, proxy):
             # POST method
             # https is tunnel. It do not modifiy DNS message
             dns_message = sendto_doh_wireformat(
-                server['ip'], data=request.pack(),
+                server['ip'], data=data or request.pack(),
                 proxy=proxy if server['proxy'] else None,
             )
             upstream_reply = DNSRecord.parse(dns_message)
             if upstream_reply.rr:
+                bogus_nxdomain = globalvars.bogus_nxdomain
+                hack_ip = globalvars.config['smartdns']['bogus_nxdomain']['hack_ip']
                 for r in upstream_reply.rr:
                     rqn = r.rname
                     rqt = QTYPE[r.rtype]
-                    if rqt in ['A', 'AAAA'] and str(r.rdata) in globalvars.bogus_nxdomain:
-                        logger.warn('\t*** Bogus Answer: %s(%s) ***' % (r.rdata, rqt))
-                        hack_ip = globalvars.config['smartdns']['bogus_nxdomain']['hack_ip']
+                    if rqt in ['A', 'AAAA'] and str(r.rdata) in bogus_nxdomain:
+                        logger.warning('\t*** Bogus Answer: %s(%s) ***', r.rdata, rqt)
                         if hack_ip:
                             hack_rqt = 'AAAA' if ':' in hack_ip else 'A'
                             hack_r = RR(
@@ -140,13 +143,13 @@ def lookup_upstream(request, reply, server, proxy):
 
         message = ['\tReturn from %(ip)s:%(port)s(%(priority)s):' % server]
         if globalvars.dig:
-            logger.warn(str(reply))
+            logger.warning('%s', reply)
         elif reply.rr:
             for r in reply.rr:
                 message.append('\t\t%s(%s)' % (r.rdata, QTYPE[r.rtype]))
         else:
             message.append('\t\tN/A')
-        logger.warn('\n'.join(message))
+        logger.warning('\n'.join(message))
         return True
     except Exception as err:
         logger.error('%s' % err)
@@ -167,7 +170,8 @@ def sendto_doh_json(url, proxy=None):
         data_io = opener.open(r)
     else:
         data_io = urllib.request.urlopen(r)
-    data = data_io.read()
+    with data_io:
+        data = data_io.read()
     data = json.loads(data)
     return data
 
@@ -187,5 +191,6 @@ def sendto_doh_wireformat(url, data=None, proxy=None):
         data_io = opener.open(r, data=data)
     else:
         data_io = urllib.request.urlopen(r, data=data)
-    data = data_io.read()
+    with data_io:
+        data = data_io.read()
     return data
@@ -6,24 +6,53 @@
 import json
 import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import netaddr
 import dnslib
 
+from .dns import pack_rr
+
 
 logger = logging.getLogger(__name__)
 
+# update in background, no more than 2 downloads at same time
+_update_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='domain-update')
+
+# built answers kept for each domain
+ANSWER_CACHE_SIZE = 4096
+
+
+def name_labels(qn):
+    """
+    lower case labels of domain name, "www.Example.com." => ('www', 'example', 'com')
+    qn: DNSLabel, str or labels converted already
+    """
+    if isinstance(qn, tuple):
+        return qn
+    name = str(qn).lower().rstrip('.')
+    return tuple(name.split('.')) if name else ()
+
 
 class Domain(object):
     """
     @:    current domain
     """
+    # search result depends on query type
+    typed_search = True
+
     def __init__(self, name):
         self.name = name + '.'
+        self.labels = name_labels(self.name)
         self.ptr_records = {}
         self.records = {}
+        # lower case labels => key of records, match name without scanning
+        self._names = {}
+        self._ptr_names = {}
+        # (labels, qtype) => answers, built once until update
+        self._answers = {}
         self.loader = None
-        self.updating = False
+        self._update_lock = threading.Lock()
 
     def __repr__(self):
         return '<Domain: %s>' % self.name
@@ -32,12 +61,14 @@ class Domain(object):
         return bool(self.records)
 
     def create(self, loader, cache=True):
+        """ return True if records are loaded """
         self.loader = loader
         try:
-            data = json.load(loader.open(cache=cache))
+            with loader.open(cache=cache) as f:
+                data = json.load(f)
         except Exception as err:
             logger.error('Load %s error: %s' % (self, err))
-            return
+            return False
         for typ, records in data.items():
             if typ in ['SOA']:
                 dn = self.get_subdomain('@')
@@ -96,6 +127,7 @@ class Domain(object):
                         ))
             else:
                 logger.warn('DNS Record %s(%s) need to be handled...' % (typ, name))
+        return True
 
     def get_subdomain(self, subname):
         if subname == '@':
@@ -106,6 +138,7 @@ class Domain(object):
             dn = subname + '.' + self.name
         if dn not in self.records:
             self.records[dn] = []
+            self._names[name_labels(dn)] = dn
         return dn
 
     def get_ptrdomain(self, ip):
@@ -113,6 +146,7 @@ class Domain(object):
         dn = ipaddr.reverse_dns
         if dn not in self.ptr_records:
             self.ptr_records[dn] = []
+            self._ptr_names[name_labels(dn)] = dn
         return dn
 
     def output_records(self):
@@ -132,29 +166,64 @@ class Domain(object):
         return line
 
     def isPtrdomain(self, qn):
-        return str(qn) in self.ptr_records
+        return name_labels(qn) in self._ptr_names
 
     def isSubdomain(self, qn):
-        return qn.matchSuffix(self.get_subdomain('@'))
+        labels = name_labels(qn)
+        start = len(labels) - len(self.labels)
+        if start < 0:
+            return False
+        return labels[start:] == self.labels
 
     def inDomain(self, qn):
-        return self.isSubdomain(qn) or self.isPtrdomain(qn)
+        # called for every query, checks are inlined
+        labels = qn if isinstance(qn, tuple) else name_labels(qn)
+        size = len(self.labels)
+        if len(labels) >= size and labels[len(labels) - size:] == self.labels:
+            return True
+        return labels in self._ptr_names
+
+    def answers(self, qn, qt, labels=None):
+        """
+        RR of search result, [(rr, outside alias, packed rr)]
+        built once for each name and type, found records only
+        """
+        # memo of records when lookup starts, replaced by update
+        memo = self._answers
+        key = (labels or name_labels(qn), qt if self.typed_search else None)
+        answers = memo.get(key)
+        if answers is None:
+            answers = []
+            for r in self.search(qn, qt, key[0]):
+                rr = dnslib.RR(
+                    rname=r['name'],
+                    rtype=getattr(dnslib.QTYPE, r['type']),
+                    rclass=1, ttl=60 * 5,
+                    rdata=r['rdata'],
+                )
+                outside = r['type'] == 'CNAME' and \
+                    not self.inDomain(r['rdata'].get_label())
+                answers.append((rr, outside, pack_rr(rr)))
+            if answers and len(memo) < ANSWER_CACHE_SIZE:
+                memo[key] = answers
+        return answers
 
-    def search(self, qn, qt):
+    def search(self, qn, qt, labels=None):
         """
         qn: query domain name, DNSLabel
         qt: query domain type, default 'A' and 'AAAA'
+        labels: name_labels of qn if they were computed by caller
         """
         r = []
-        if qt == 'PTR' and self.isPtrdomain(qn):
-            for name, rrs in self.ptr_records.items():
-                if qn == name:
-                    for rdata in rrs:
-                        r.append({
-                            'name': name,
-                            'type': 'PTR',
-                            'rdata': rdata,
-                        })
+        key = labels or name_labels(qn)
+        if qt == 'PTR' and self.isPtrdomain(key):
+            name = self._ptr_names[key]
+            for rdata in self.ptr_records.get(name, []):
+                r.append({
+                    'name': name,
+                    'type': 'PTR',
+                    'rdata': rdata,
+                })
             if not r:
                 rdata = dnslib.PTR(
                     '-'.join(str(qn).split('.')[:-3][::-1]) +
@@ -166,97 +235,126 @@ class Domain(object):
                     'type': 'PTR',
                     'rdata': rdata,
                 })
-        elif self.isSubdomain(qn):
-            for name, rrs in self.records.items():
-                if name == qn:
-                    for rdata in rrs:
-                        rqt = rdata.__class__.__name__
-                        if rqt in ['SRV']:
-                            r.append({
-                                'name': name,
-                                'type': rqt,
-                                'rdata': rdata,
-                            })
-                            logger.debug('Find: %s => %s(%s)' % (
-                                name, rqt, rdata
-                            ))
-                            r += self.search(rdata.target, 'A')
-                        elif rqt in ['CNAME']:
-                            r.append({
-                                'name': name,
-                                'type': rqt,
-                                'rdata': rdata,
-                            })
-                            logger.debug('Find: %s => %s(%s)' % (
-                                name, rqt, rdata
-                            ))
-                            r += self.search(rdata.label, qt)
-                        elif qt in ['*', rqt]:
-                            r.append({
-                                'name': name,
-                                'type': rqt,
-                                'rdata': rdata,
-                            })
-                            logger.debug('Find: %s => %s(%s)' % (
-                                name, rqt, rdata
-                            ))
+        elif self.isSubdomain(key):
+            name = self._names.get(key)
+            for rdata in self.records.get(name, []):
+                rqt = rdata.__class__.__name__
+                if rqt in ['SRV']:
+                    r.append({
+                        'name': name,
+                        'type': rqt,
+                        'rdata': rdata,
+                    })
+                    logger.debug('Find: %s => %s(%s)' % (
+                        name, rqt, rdata
+                    ))
+                    r += self.search(rdata.target, 'A')
+                elif rqt in ['CNAME']:
+                    r.append({
+                        'name': name,
+                        'type': rqt,
+                        'rdata': rdata,
+                    })
+                    logger.debug('Find: %s => %s(%s)' % (
+                        name, rqt, rdata
+                    ))
+                    r += self.search(rdata.label, qt)
+                elif qt in ['*', rqt]:
+                    r.append({
+                        'name': name,
+                        'type': rqt,
+                        'rdata': rdata,
+                    })
+                    logger.debug('Find: %s => %s(%s)' % (
+                        name, rqt, rdata
+                    ))
         return r
 
     def isNeedUpdate(self, refresh):
-        if self.updating or refresh == 0:
+        if self._update_lock.locked() or refresh == 0:
             return False
         if not self.records:
             return True
         return self.loader.isNeedUpdate(refresh)
 
-    def async_update(self, loader=None):
-        t = threading.Thread(
-            target=self.update,
-            kwargs={
-                'loader': loader,
-                'cache': False,
-            }
-        )
-        t.start()
+    def async_update(self, loader=None, cache=False):
+        # only one update at same time, skip if updating
+        if not self._update_lock.acquire(blocking=False):
+            return
+
+        def locked_update():
+            try:
+                self._update(loader=loader, cache=cache)
+            finally:
+                self._update_lock.release()
+        try:
+            _update_pool.submit(locked_update)
+        except Exception:
+            self._update_lock.release()
+            raise
 
     def update(self, loader=None, cache=True):
+        with self._update_lock:
+            self._update(loader=loader, cache=cache)
+
+    def _update(self, loader=None, cache=True):
         if not loader:
             loader = self.loader
-        self.updating = True
         logger.warn('Update domain %s', loader)
-        self.ptr_records = {}
-        self.records = {}
-        self.create(loader, cache)
-        self.updating = False
+        # load into new domain, lookups use old records until replaced
+        domain = self.__class__(self.name[:-1])
+        if not domain.create(loader, cache):
+            # failed download or bad data, keep old records
+            return
+        self.loader = domain.loader
+        self.ptr_records = domain.ptr_records
+        self.records = domain.records
+        self._names = domain._names
+        self._ptr_names = domain._ptr_names
+        # lookup started with old records stores answers into old memo
+        self._answers = {}
 
 
 class HostDomain(Domain):
     """
     transfer hosts file into special domain
     """
+    # all records of name are returned for any query type
+    typed_search = False
+
     def create(self, loader, cache=True):
-        """ All are A or AAAA record in hosts file"""
+        """ All are A or AAAA record in hosts file, return True if loaded """
         self.loader = loader
         try:
             loader_io = loader.open(cache=cache)
         except Exception as err:
             logger.error('Load %s error: %s' % (self, err))
-            return
+            return False
+        # big hosts file maps many names to same ip, share one rdata
+        rdatas = {}
+        line = ''
         try:
-            for line in iter(loader_io.readline, ''):
-                line = line.strip()
-                if not line or line.startswith('#'):
+            with loader_io:
+                lines = loader_io.read().splitlines()
+            for line in lines:
+                fields = line.split(None, 2)
+                if not fields or fields[0].startswith('#'):
                     continue
-                ip, name = line.split()[:2]
-                dn = self.get_subdomain(name)
-                if ip.startswith('@'):
-                    self.records[dn] += [dnslib.CNAME(ip[1:])]
-                elif ':' in ip:
-                    self.records[dn] += [dnslib.AAAA(ip)]
-                else:
-                    self.records[dn] += [dnslib.A(ip)]
+                ip, name = fields[:2]
+                rdata = rdatas.get(ip)
+                if rdata is None:
+                    if ip.startswith('@'):
+                        rdata = dnslib.CNAME(ip[1:])
+                    elif ':' in ip:
+                        rdata = dnslib.AAAA(ip)
+                    else:
+                        rdata = dnslib.A(ip)
+                    rdatas[ip] = rdata
+                self.records[self.get_subdomain(name)].append(rdata)
         except Exception as err:
             logger.error('Load %s error: %s (%s)' % (self, err, line))
+            return False
+        return True
 
     def get_subdomain(self, subname):
         if subname == '@':
@@ -265,27 +363,32 @@ class HostDomain(Domain):
             dn = subname + '.'
         if dn not in self.records:
             self.records[dn] = []
+            self._names[name_labels(dn)] = dn
         return dn
 
     def isSubdomain(self, qn):
-        return str(qn) in self.records
+        return name_labels(qn) in self._names
+
+    def inDomain(self, qn):
+        labels = qn if isinstance(qn, tuple) else name_labels(qn)
+        return labels in self._names or labels in self._ptr_names
 
-    def search(self, qn, qt):
+    def search(self, qn, qt, labels=None):
         """
         qn: query domain name, DNSLabel
         qt: query domain type, default 'A' and 'AAAA'
+        labels: name_labels of qn if they were computed by caller
         """
         r = []
-        for name, rrs in self.records.items():
-            if name == qn:
-                for rdata in rrs:
-                    rqt = rdata.__class__.__name__
-                    r.append({
-                        'name': name,
-                        'type': rqt,
-                        'rdata': rdata,
-                    })
-                    logger.debug('Find: %s => %s(%s)' % (
-                        name, rqt, rdata
-                    ))
+        name = self._names.get(labels or name_labels(qn))
+        for rdata in self.records.get(name, []):
+            rqt = rdata.__class__.__name__
+            r.append({
+                'name': name,
+                'type': rqt,
+                'rdata': rdata,
+            })
+            logger.debug('Find: %s => %s(%s)' % (
+                name, rqt, rdata
+            ))
         return r
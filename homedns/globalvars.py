@@ -28,6 +28,8 @@ class defaults():
         # allowed hosts to access
         # 192.168.1.0/24, 192.168.2.10-100, 192.168.3.*, 192.168.*.*
         'allowed_hosts': ['127.0.0.1'],
+        # processes serving UDP on same port with SO_REUSEPORT, Linux/BSD only
+        'workers': 1,
     }
     smartdns = {
         # match rule by order in list.
@@ -223,6 +225,8 @@ def init():
     global config
     global local_domains
     global allowed_hosts
+    global allowed_ips
+    global allowed_ranges
     global upstreams
     global rules
     global bogus_nxdomain
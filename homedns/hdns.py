@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 # -*- encoding:utf-8 -*-
 
+import os
 import os.path
+import sys
 import argparse
 import logging
 import time
 import json
+import heapq
+import signal
+import socket
 import threading
-from collections import OrderedDict
-
 import netaddr
 
 from . import globalvars
@@ -20,6 +23,17 @@ from .iniconfig import ini_read, ini_write
 from .dhcp import getdns
 
 
+# minimum seconds between checking rules and domains for update
+REFRESH_INTERVAL = 60
+
+
+def get_app_logger():
+    if '.' in __name__:
+        return logging.getLogger(__name__.partition('.')[0])
+    else:
+        return logging.getLogger('homedns')
+
+
 def init_config(args):
     globalvars.init()
 
@@ -79,11 +93,9 @@ def init_config(args):
     console_handler.setFormatter(formatter)
     console_handler.setLevel(log_level)
 
-    if '.' in __name__:
-        app_logger = logging.getLogger(__name__.partition('.')[0])
-    else:
-        app_logger = logging.getLogger('homedns')
-    app_logger.setLevel(logging.DEBUG)
+    app_logger = get_app_logger()
+    # lowest level of handlers, so isEnabledFor() skips unused messages
+    app_logger.setLevel(min(log_level, log_level2))
     app_logger.addHandler(file_handler)
     app_logger.addHandler(console_handler)
 
@@ -122,10 +134,12 @@ def init_config(args):
             f.write('#   192.168.3.*\n')
             f.write('#   192.168.*.*\n')
     try:
-        loader_io = loader.open(cache=True)
+        with loader.open(cache=True) as f:
+            lines = f.read().splitlines()
     except Exception as err:
         logger.error('Load %s error: %s' % (name, err))
-    for line in iter(loader_io.readline, ''):
+        lines = []
+    for line in lines:
         line = line.strip()
         if not line or line.startswith('#'):
             continue
@@ -163,8 +177,8 @@ def init_config(args):
             ['%(ip)s:%(port)s(%(priority)s)' % dns for dns in upstreams[name]],
         ))
 
-    # rules
-    globalvars.rules = OrderedDict()
+    # rules, matched by order: [(name, adblock, servers, refresh)]
+    globalvars.rules = []
     for rule in globalvars.config['smartdns']['rules']:
         name = rule['name']
         loader = TxtLoader(
@@ -189,14 +203,15 @@ def init_config(args):
         dns_group = [dns for dns in rule['dns'] if dns in upstreams]
         logger.debug('\tblock list:\n\t\t' + '\n\t\t'.join(ab.output_list()))
         logger.warn('\twith DNS group: %s' % dns_group)
-        globalvars.rules[name] = {
-            'rule': ab,
-            'upstreams': dns_group,
-            'refresh': rule['refresh'],
-        }
+        # all servers of DNS group
+        servers = [
+            server for group in dns_group for server in upstreams[group]
+        ]
+        globalvars.rules.append((name, ab, servers, rule['refresh']))
 
     # allowed hosts
     globalvars.allowed_hosts = netaddr.IPSet()
+    allowed_ips = set()
     logger.warn('Allowed hosts:')
     for hosts in globalvars.config['server']['allowed_hosts']:
         logger.warn('\t%s' % hosts)
@@ -206,6 +221,14 @@ def init_config(args):
             globalvars.allowed_hosts.add(netaddr.IPNetwork(hosts))
         else:
             globalvars.allowed_hosts.add(hosts)
+            allowed_ips.add(hosts)
+    # match single host without creating netaddr.IPAddress
+    globalvars.allowed_ips = frozenset(allowed_ips)
+    # sorted integer ranges of IPv4 hosts, match client by bisect
+    globalvars.allowed_ranges = [
+        (r.first, r.last) for r in globalvars.allowed_hosts.iter_ipranges()
+        if r.version == 4
+    ]
 
     # local domains
     globalvars.local_domains = {}
@@ -241,11 +264,8 @@ def init_config(args):
             )
             if loader.local and not os.path.exists(loader.url):
                 if domain['name'] == 'mylocal.home' and domain['url'] == 'mylocal.home.json':
-                    json.dump(
-                        globalvars.defaults.mylocal_home,
-                        open(loader.url, 'w'),
-                        indent=4,
-                    )
+                    with open(loader.url, 'w') as f:
+                        json.dump(globalvars.defaults.mylocal_home, f, indent=4)
                 else:
                     raise OSError('Not found Domain %s: %s' % (
                         domain['name'],
@@ -264,6 +284,97 @@ def init_config(args):
         }
 
 
+def next_refresh(updater, refresh, interval=REFRESH_INTERVAL, download=True):
+    """
+    time to check updater again, local file is checked every interval,
+    remote one is due after refresh seconds from last update
+    """
+    now = time.time()
+    loader = updater.loader
+    if loader is None or loader.local or not download:
+        return now + interval
+    return max(now + interval, loader.lastUpdateTime() + refresh)
+
+
+def refresh_loop(interval=REFRESH_INTERVAL, download=True):
+    """
+    check and update rules and local domains in background
+    heap: [(next check time, index, updater, refresh)], sleep until first one
+    download: False in worker process, reload remote one from cache written
+              by main process, do not download at same time
+    """
+    updaters = [
+        (rule, refresh) for _, rule, _, refresh in globalvars.rules
+    ] + [
+        (value['domain'], value['refresh']) for value in globalvars.local_domains.values()
+    ]
+    heap = [
+        (next_refresh(updater, refresh, interval, download), index, updater, refresh)
+        for index, (updater, refresh) in enumerate(updaters)
+        # never update
+        if refresh
+    ]
+    heapq.heapify(heap)
+    while heap:
+        due, index, updater, refresh = heap[0]
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+            continue
+        loader = updater.loader
+        try:
+            if not download and loader and not loader.local:
+                if loader.isCacheUpdated():
+                    updater.async_update(cache=True)
+            elif updater.isNeedUpdate(refresh):
+                updater.async_update()
+        except Exception as err:
+            logger.error('Refresh %s error: %s' % (updater, err))
+        heapq.heapreplace(
+            heap,
+            (next_refresh(updater, refresh, interval, download), index, updater, refresh),
+        )
+
+
+def fork_workers(workers):
+    """
+    fork processes to serve UDP on same port, rules and domains are shared
+    by copy-on-write, but cache is owned by each process.
+    return (index of worker, pids of children), 0 for main process
+    """
+    children = []
+    for index in range(1, workers):
+        pid = os.fork()
+        if pid == 0:
+            return index, []
+        children.append(pid)
+    return 0, children
+
+
+def worker_log(index):
+    """ log into own file in worker process, rollover is not shared """
+    app_logger = get_app_logger()
+    for handler in list(app_logger.handlers):
+        if not isinstance(handler, logging.handlers.TimedRotatingFileHandler):
+            continue
+        worker_handler = logging.handlers.TimedRotatingFileHandler(
+            filename='%s.%s' % (handler.baseFilename, index),
+            when='D',
+            interval=1,
+            backupCount=7,
+            utc=False,
+        )
+        worker_handler.setFormatter(handler.formatter)
+        worker_handler.setLevel(handler.level)
+        app_logger.removeHandler(handler)
+        handler.close()
+        app_logger.addHandler(worker_handler)
+
+
+def stop(signum, frame):
+    sys.exit(0)
+
+
 def run():
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', action='version',
@@ -289,12 +400,35 @@ def run():
 
     binds = globalvars.config['server']['binds']
 
+    workers = globalvars.config['server'].get('workers', 1)
+    reuse_port = workers > 1
+    if reuse_port and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        logger.error('Multiple workers are not supported on this platform, use one.')
+        reuse_port = False
+    # fork before server and refresh threads start,
+    # threads writing cache in init_config keep running in main process only
+    parent = os.getpid()
+    worker, children = fork_workers(workers) if reuse_port else (0, [])
+    if worker:
+        worker_log(worker)
+        logger.warn('UDP worker %s running in process: %s' % (worker, os.getpid()))
+    elif children:
+        # stop and reap workers when main process is terminated
+        signal.signal(signal.SIGTERM, stop)
+
     servers = []
     for bind in binds:
-        logger.warn('Listen on %(protocol)s://%(ip)s:%(port)s' % bind)
+        if worker and 'udp' != bind['protocol']:
+            continue
+        if not worker:
+            logger.warn('Listen on %(protocol)s://%(ip)s:%(port)s' % bind)
         if 'udp' == bind['protocol']:
             servers.append(
-                transport.ThreadingUDPServer((bind['ip'], bind['port']), transport.UDPRequestHandler)
+                transport.ThreadingUDPServer(
+                    (bind['ip'], bind['port']),
+                    transport.UDPRequestHandler,
+                    reuse_port=reuse_port,
+                )
             )
         if 'tcp' == bind['protocol']:
             servers.append(
@@ -302,7 +436,7 @@ def run():
             )
 
     for s in servers:
-        # that thread will start one more thread for each request
+        # requests are handled by worker pool of transport
         thread = threading.Thread(target=s.serve_forever)
         # exit the server thread when the main thread terminates
         thread.daemon = True
@@ -312,14 +446,28 @@ def run():
             thread.name
         ))
 
+    # only main process downloads remote rules and domains
+    thread = threading.Thread(target=refresh_loop, kwargs={'download': not worker})
+    thread.daemon = True
+    thread.start()
+
     try:
         while True:
             time.sleep(1)
+            if worker and os.getppid() != parent:
+                logger.error('Main process exited, stop worker %s' % worker)
+                break
     except KeyboardInterrupt:
         pass
     finally:
         for s in servers:
             s.shutdown()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
 
 
 if __name__ == '__main__':
@@ -27,6 +27,10 @@ def ini_read(config_file):
 
     server['search'] = strip_item(cfg.get('server', 'search').split(','))
     server['allowed_hosts'] = strip_item(cfg.get('server', 'allowed_hosts').split(','))
+    if cfg.has_option('server', 'workers'):
+        server['workers'] = cfg.getint('server', 'workers')
+    else:
+        server['workers'] = 1
     smartdns = {}
     smartdns['rules'] = []
     for rule in strip_item(cfg.get('smartdns', 'rules').split(',')):
@@ -108,6 +112,8 @@ def ini_write(config, config_file):
     line.append('%s = %s' % ('search', ','.join(config['server']['search'])))
     line.append('# 允许访问的客户端范围: 192.168.1.0/24, 192.1682.10-100, 192.168.3.*')
     line.append('%s = %s' % ('allowed_hosts', ','.join(config['server']['allowed_hosts'])))
+    line.append('# UDP 服务进程数, 多进程通过 SO_REUSEPORT 共享端口, 仅支持 Linux/BSD')
+    line.append('%s = %s' % ('workers', config['server'].get('workers', 1)))
     line.append('')
 
     line.append('[smartdns]')
@@ -4,9 +4,12 @@
 
 import logging
 import base64
+import re
 import os
 import os.path
 import time
+import tempfile
+import threading
 
 from six.moves.urllib.parse import urlparse
 from six.moves.urllib.request import urlopen, Request, build_opener
@@ -20,6 +23,9 @@ from . import globalvars
 
 logger = logging.getLogger(__name__)
 
+BASE64_SNIFF_SIZE = 256
+BASE64_RE = re.compile(br'[A-Za-z0-9+/=]+')
+
 
 class BaseLoader(object):
     def __init__(self, url, name=None, proxy=None):
@@ -47,18 +53,28 @@ class BaseLoader(object):
         return '<%s: %s>' % (self.__class__.__name__, self.url)
 
     def is_base64(self, data):
-        if not isinstance(data, str):
-            data = data.decode('utf-8')
-        lines = data.strip().split('\n')
-        nums = list(map(len, lines))
-        for x in range(len(nums) - 1):
-            if nums[x] != 64:
-                return False
-        if nums[-1] % 4 != 0:
+        """
+        sniff head of data only.
+        base64 data is wrapped in same width, 64 by openssl, 76 by base64
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        head = data[:BASE64_SNIFF_SIZE].strip()
+        if not head:
             return False
-        if not lines[-1][0].isalnum():
+        lines = head.split(b'\n')
+        width = len(lines[0].rstrip(b'\r'))
+        if len(lines) > 1 and width % 4 != 0:
+            return False
+        for line in lines[:-1]:
+            line = line.rstrip(b'\r')
+            if len(line) != width or not BASE64_RE.fullmatch(line):
+                return False
+        # last line may be truncated by sniff size
+        line = lines[-1].rstrip(b'\r')
+        if not BASE64_RE.fullmatch(line):
             return False
-        if '.' in lines[-1]:
+        if len(data) <= BASE64_SNIFF_SIZE and len(line) % 4 != 0:
             return False
         return True
 
@@ -81,23 +97,49 @@ class BaseLoader(object):
                 data_io = opener.open(r)
             else:
                 data_io = urlopen(r)
-            data = data_io.read()
+            with data_io:
+                data = data_io.read()
             if self.is_base64(data):
                 logger.debug('BASE64 decode...')
                 data = base64.b64decode(data)
             if not isinstance(data, str):
                 data = data.decode('utf-8')
             if self.cache:
-                with open(self.cache, 'w') as f:
-                    f.write(data)
-                self._last_update_time = os.stat(self.cache).st_mtime
-                return open(self.cache)
+                t = threading.Thread(target=self._write_cache, args=(data,))
+                t.daemon = True
+                t.start()
             self._last_update_time = time.time()
             return StringIO(data)
 
+    def _write_cache(self, data):
+        """
+        write to unique temporary file, then replace cache file atomically
+        concurrent writers (threads or worker processes) never share one file
+        """
+        tmp_file = None
+        try:
+            fd, tmp_file = tempfile.mkstemp(
+                prefix=os.path.basename(self.cache) + '.',
+                suffix='.tmp',
+                dir=os.path.dirname(self.cache),
+            )
+            with open(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_file, self.cache)
+        except Exception as err:
+            logger.error('Write cache %s error: %s' % (self.cache, err))
+            if tmp_file and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
     def lastUpdateTime(self):
         return self._last_update_time
 
+    def isCacheUpdated(self):
+        """ cache is written by other process after loaded """
+        if self.local or not os.path.exists(self.cache):
+            return False
+        return os.stat(self.cache).st_mtime > self._last_update_time
+
     def isNeedUpdate(self, refresh):
         if self.local:
             return self.lastUpdateTime() != os.stat(self.url).st_mtime
@@ -123,5 +165,6 @@ if __name__ == '__main__':
     globalvars.init()
     globalvars.config_dir = ''
     loader = TxtLoader(args.url)
-    data = loader.open().read()
+    with loader.open() as f:
+        data = f.read()
     print(data)
@@ -1,93 +1,101 @@
 
-import binascii
+import time
+import struct
 import logging
+from operator import itemgetter
 
 
 from . import globalvars
-from dnslib import RR, QTYPE, DNSRecord, DNSHeader, DNSLabel
+from dnslib import QTYPE, DNSRecord, DNSHeader, DNSLabel
 
 from .cache import DNSCache
+from .domain import name_labels
 from . import dns
 from . import doh
 
 logger = logging.getLogger(__name__)
 
+# max size of UDP message without EDNS (RFC 1035)
+UDP_SIZE = 512
 
-def lookup_local(request, reply):
+
+def lookup_local(request, reply, qlabels=None, packed_answers=None):
+    """
+    qlabels: name_labels of request, computed once for all matchers
+    packed_answers: list to collect packed local answers
+    """
     qn2 = qn = request.q.qname
     qt = QTYPE[request.q.qtype]
+    qlabels2 = qlabels = qlabels or name_labels(qn)
 
     indomain = False
+    hack_srv = qt == 'SRV' and globalvars.config['smartdns']['hack_srv']
 
     for value in globalvars.local_domains.values():
         domain = value['domain']
-        if globalvars.config['smartdns']['hack_srv'] and qt == 'SRV' and \
-                not domain.inDomain(qn2):
+        if hack_srv and not domain.inDomain(qlabels2):
             r_srv = b'.'.join(qn.label[:2])
-            if r_srv.decode().lower() in globalvars.config['smartdns']['hack_srv']:
+            if '.'.join(qlabels[:2]) in hack_srv:
                 qn2 = DNSLabel(domain.get_subdomain('@')).add(r_srv)
-                logger.warn('\tChange SRV request to %s from %s' % (qn2, qn))
+                qlabels2 = name_labels(qn2)
+                logger.warning('\tChange SRV request to %s from %s', qn2, qn)
 
-        if domain.inDomain(qn2):
+        if domain.inDomain(qlabels2):
             indomain = True
-            logger.warn('\tRequest "%s(%s)" is in "local" list.' % (qn, qt))
-            rr_data = domain.search(qn2, qt)
-            if rr_data:
-                for r in rr_data:
-                    answer = RR(
-                        rname=r['name'],
-                        rtype=getattr(QTYPE, r['type']),
-                        rclass=1, ttl=60 * 5,
-                        rdata=r['rdata'],
+            logger.warning('\tRequest "%s(%s)" is in "local" list.', qn, qt)
+            for answer, outside, packed in domain.answers(qn2, qt, qlabels2):
+                reply.add_answer(answer)
+                if packed_answers is not None:
+                    packed_answers.append(packed)
+
+                if outside:
+                    logger.warning('\tOutside alias "%s"', answer.rdata)
+                    alias_request = DNSRecord.question(str(answer.rdata))
+                    alias_reply = DNSRecord(
+                        DNSHeader(id=alias_request.header.id, qr=1, aa=1, ra=1),
+                        q=alias_request.q
                     )
-                    reply.add_answer(answer)
-
-                    if r['type'] == 'CNAME' and not domain.inDomain(r['rdata'].get_label()):
-                        logger.warn('\tOutside alias "%s"' % r['rdata'])
-                        alias_request = DNSRecord.question(str(r['rdata']))
-                        alias_reply = DNSRecord(
-                            DNSHeader(id=alias_request.header.id, qr=1, aa=1, ra=1),
-                            q=alias_request.q
-                        )
-                        lookup_upstream(alias_request, alias_reply)
-                        for r in alias_reply.rr:
-                            reply.add_answer(r)
-                break
+                    lookup_upstream(alias_request, alias_reply)
+                    for r in alias_reply.rr:
+                        reply.add_answer(r)
+            break
 
     # log
     if indomain:
-        logger.warn('\tReturn from LOCAL:')
+        logger.warning('\tReturn from LOCAL:')
         if globalvars.dig:
-            logger.warn(str(reply))
+            logger.warning('%s', reply)
         elif reply.rr:
             for r in reply.rr:
-                logger.warn('\t\t%s(%s)' % (r.rdata, QTYPE[r.rtype]))
+                logger.warning('\t\t%s(%s)', r.rdata, QTYPE[r.rtype])
         else:
-            logger.warn('\t\tN/A')
+            logger.warning('\t\tN/A')
 
     return indomain
 
 
-def lookup_upstream(request, reply):
+def lookup_upstream(request, reply, data=None, qlabels=None):
+    """
+    data: raw request message
+    qlabels: name_labels of request
+    """
     qn = request.q.qname
-    qt = QTYPE[request.q.qtype]
     proxy = globalvars.config['smartdns']['proxy']
-    qn2 = str(qn).rstrip('.')
-
-    for name, param in globalvars.rules.items():
-        if param['rule'].isBlock(qn2):
-            logger.warn('\tRequest "%s(%s)" is in "%s" list.' % (qn, qt, name))
-            servers = []
-            for group in param['upstreams']:
-                servers.extend(globalvars.upstreams[group])
-            servers.sort(key=lambda x: x['priority'], reverse=True)
+    qlabels = qlabels or name_labels(qn)
+
+    for name, rule, servers, _ in globalvars.rules:
+        if rule.isBlock(qlabels):
+            logger.warning('\tRequest "%s(%s)" is in "%s" list.',
+                           qn, QTYPE[request.q.qtype], name)
+            # priority is changed by every query, sort a copy
+            servers = sorted(servers, key=itemgetter('priority'), reverse=True)
             for server in servers:
                 # try query servers by priority
                 ret = None
                 if server['protocol'] == 'dns':
-                    ret = dns.lookup_upstream(request, reply, server, proxy)
+                    ret = dns.lookup_upstream(request, reply, server, proxy, data)
                 elif server['protocol'].startswith('doh'):
-                    ret = doh.lookup_upstream(request, reply, server, proxy)
+                    ret = doh.lookup_upstream(request, reply, server, proxy, data)
                 if ret:
                     if reply.rr:
                         # find and return
@@ -103,54 +111,69 @@ def lookup_upstream(request, reply):
 
 
 def dns_response(handler, data):
+    # only parse question for cache
+    try:
+        txid, qname, qtype, qclass, q_end = dns.parse_question(data)
+        key = (qname, qtype, qclass)
+    except Exception:
+        key = None
+    cache_data = key and DNSCache.get(key)
+    if cache_data:
+        packed, cache_reply, offsets, added = cache_data
+        logger.warning('\tRequest "%s(%s)" is in CACHE.',
+                       cache_reply.q.qname, QTYPE[qtype])
+        logger.warning('\tReturn from CACHE:')
+        if globalvars.dig:
+            logger.warning('%s', cache_reply)
+        else:
+            for r in cache_reply.rr + cache_reply.auth + cache_reply.ar:
+                logger.warning('\t\t%s(%s)', r.rdata, QTYPE[r.rtype])
+        # replace with ID and question of request, same size as cached one
+        response = bytearray(packed)
+        struct.pack_into('!H', response, 0, txid)
+        response[12:q_end] = data[12:q_end]
+        # decrease TTLs by the time in cache
+        elapsed = int(time.monotonic() - added)
+        if elapsed:
+            for offset in offsets:
+                ttl = struct.unpack_from('!I', response, offset)[0]
+                struct.pack_into('!I', response, offset, max(ttl - elapsed, 0))
+        handler.send_data(response)
+        return
+
     try:
         request = DNSRecord.parse(data)
     except Exception as err:
-        logger.error('Parse request error: %s %s %s' % (
-            err, len(data), binascii.b2a_hex(data)))
+        logger.error('Parse request error: %s %s %s', err, len(data), data.hex())
         return
 
     reply = DNSRecord(
         DNSHeader(id=request.header.id, qr=1, aa=1, ra=1),
         q=request.q
     )
-
-    qn = request.q.qname
-    qt = QTYPE[request.q.qtype]
-    key = '%s|%s' % (qn, qt)
-    cache_reply = DNSCache.get(key)
-    if cache_reply:
-        reply.add_answer(*cache_reply.rr)
-        reply.add_auth(*cache_reply.auth)
-        reply.add_ar(*cache_reply.ar)
-
-        logger.warn('\tRequest "%s(%s)" is in CACHE.' % (qn, qt))
-        logger.warn('\tReturn from CACHE:')
-        if globalvars.dig:
-            logger.warn(str(reply))
-        else:
-            for r in reply.rr:
-                logger.warn('\t\t%s(%s)' % (r.rdata, QTYPE[r.rtype]))
-            for r in reply.auth:
-                logger.warn('\t\t%s(%s)' % (r.rdata, QTYPE[r.rtype]))
-            for r in reply.ar:
-                logger.warn('\t\t%s(%s)' % (r.rdata, QTYPE[r.rtype]))
-    else:
-        if 'local' in globalvars.config['server']['search']:
-            indomain = lookup_local(request, reply)
-        if not indomain and 'upstream' in globalvars.config['server']['search']:
-            lookup_upstream(request, reply)
-        if reply.rr:
-            DNSCache.add(key, reply)
-
-    handler.send_data(reply.pack())
-
-    # update
-    for value in globalvars.rules.values():
-        rule = value['rule']
-        if rule.isNeedUpdate(value['refresh']):
-            rule.async_update()
-    for value in globalvars.local_domains.values():
-        domain = value['domain']
-        if domain.isNeedUpdate(value['refresh']):
-            domain.async_update()
+    qlabels = name_labels(request.q.qname)
+    indomain = False
+    packed_answers = []
+    if 'local' in globalvars.config['server']['search']:
+        indomain = lookup_local(request, reply, qlabels, packed_answers)
+    if not indomain and 'upstream' in globalvars.config['server']['search']:
+        lookup_upstream(request, reply, data, qlabels)
+
+    packed = None
+    if indomain and key and len(packed_answers) == len(reply.rr):
+        # all answers are local, copy packed ones without dnslib
+        packed = dns.pack_reply(reply.header, data[12:q_end], packed_answers)
+        if len(packed) > UDP_SIZE:
+            # may be too large for UDP without EDNS, compress all names by
+            # dnslib, cached reply is same for any request and transport
+            packed = None
+    if packed is None:
+        packed = reply.pack()
+    if key and reply.rr:
+        # expire with the minimum TTL of answers
+        ttl = min(r.ttl for r in reply.rr)
+        if ttl > 0:
+            DNSCache.add(key, (
+                packed, reply, dns.ttl_offsets(packed, q_end), time.monotonic(),
+            ), ttl)
+    handler.send_data(packed)
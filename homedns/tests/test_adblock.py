@@ -0,0 +1,132 @@
+import itertools
+
+import pytest
+
+from ..adblock import Adblock, DomainTrie
+from ..loader import TxtLoader
+
+
+RULES = """\
+! comment
+[Adblock Plus 2.0]
+||example.com
+||ads.example.com
+@@||good.ads.example.com
+@@||white.example.com
+|http://tracker.net/
+*.cdn.org
+@@*.ok.cdn.org
+1.1.1.1
+localhost
+"""
+
+HOSTS = [
+    'example.com',
+    'www.example.com',
+    'badexample.com',
+    'ads.example.com',
+    'x.ads.example.com',
+    'good.ads.example.com',
+    'x.good.ads.example.com',
+    'white.example.com',
+    'a.white.example.com',
+    'tracker.net',
+    'sub.tracker.net',
+    'cdn.org',
+    'img.cdn.org',
+    'ok.cdn.org',
+    'a.ok.cdn.org',
+    'example.org',
+    'com',
+]
+
+
+def in_list(domain_list, host):
+    """ level rules of domain list before trie, longest match wins """
+    level = 0
+    for domain in domain_list:
+        if domain == '.*':
+            level = max(level, 1)
+        elif '.' + host == domain:
+            level = 100
+        elif host[-len(domain):] == domain:
+            level = max(level, len(domain))
+    return level
+
+
+def is_block(adblock, host):
+    return in_list(adblock.blacklist, host) > in_list(adblock.whitelist, host)
+
+
+def create(tmp_path, rules):
+    rules_file = tmp_path / 'test.rules'
+    rules_file.write_text(rules, encoding='utf-8')
+    adblock = Adblock('test')
+    adblock.create(TxtLoader(str(rules_file)))
+    return adblock
+
+
+def test_parse_rules(tmp_path):
+    adblock = create(tmp_path, RULES)
+    assert adblock.blacklist == {
+        '.example.com', '.ads.example.com', '.tracker.net', '.cdn.org',
+    }
+    assert adblock.whitelist == {
+        '.good.ads.example.com', '.white.example.com', '.ok.cdn.org',
+    }
+
+
+@pytest.mark.parametrize('host', HOSTS)
+def test_is_block(tmp_path, host):
+    adblock = create(tmp_path, RULES)
+    expected = is_block(adblock, host)
+    assert adblock.isBlock(host) == expected
+    assert adblock.isBlock(tuple(host.split('.'))) == expected
+    assert adblock.isBlack(host) == in_list(adblock.blacklist, host)
+    assert adblock.isWhite(host) == in_list(adblock.whitelist, host)
+
+
+@pytest.mark.parametrize('rules', [
+    '*.*\n',
+    '*.*\n@@||example.com\n',
+    '@@*.*\n||ads.example.com\n',
+    '*.*\n@@*.*\n',
+    '',
+])
+def test_wildcard(tmp_path, rules):
+    adblock = create(tmp_path, rules)
+    for host in HOSTS:
+        assert adblock.isBlock(host) == is_block(adblock, host), host
+
+
+def test_update(tmp_path):
+    adblock = create(tmp_path, '||example.com\n')
+    assert adblock.isBlock('www.example.com')
+    rules_file = tmp_path / 'test.rules'
+    rules_file.write_text('@@||example.com\n||ads.example.com\n', encoding='utf-8')
+    adblock.update()
+    assert not adblock.isBlock('www.example.com')
+    assert adblock.isBlock('ads.example.com')
+
+
+def test_trie_levels():
+    labels = ['a', 'b', 'c', 'd']
+    domains = [
+        '.' + '.'.join(labels[i:]) for i in range(len(labels))
+    ] + ['.x.c.d', '.*']
+    # every split of domains into black and white lists
+    for flags in itertools.product((None, 0, 1), repeat=len(domains)):
+        lists = (set(), set())
+        trie = DomainTrie(2)
+        for domain, index in zip(domains, flags):
+            if index is None:
+                continue
+            lists[index].add(domain)
+            if domain == '.*':
+                trie.insert([], 1, index)
+            else:
+                trie.insert(domain[1:].split('.')[::-1], len(domain), index)
+        for host in ('a.b.c.d', 'b.c.d', 'z.b.c.d', 'x.c.d', 'c.d', 'y.d', 'e'):
+            expected = [in_list(lists[i], host) for i in range(2)]
+            levels = trie.match(tuple(host.split('.')))
+            assert list(levels) == expected, (host, lists)
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+import pytest
+
+from .. import cache
+from ..cache import MemoryCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class SmallCache(MemoryCache):
+    _maxsize = 3
+    _mobj = OrderedDict()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    SmallCache.clear()
+    yield clock
+    SmallCache.clear()
+
+
+def test_expire(clock):
+    SmallCache.add('a', 1, 10)
+    SmallCache.add('b', 2)
+    assert SmallCache.get('a') == 1
+    clock.now += 10
+    assert SmallCache.get('a') == 1
+    clock.now += 0.1
+    assert SmallCache.get('a') is None
+    assert 'a' not in SmallCache._mobj
+    # default timeout
+    assert SmallCache.get('b') == 2
+    clock.now += SmallCache._timeout
+    assert SmallCache.get('b') is None
+
+
+def test_lru(clock):
+    for key in 'abc':
+        SmallCache.add(key, key, 10)
+    # "a" is used recently, "b" is dropped
+    assert SmallCache.get('a') == 'a'
+    SmallCache.add('d', 'd', 10)
+    assert SmallCache.get('b') is None
+    assert [SmallCache.get(key) for key in 'acd'] == ['a', 'c', 'd']
+    # add again refreshes expiry and order
+    SmallCache.add('a', 'A', 20)
+    SmallCache.add('e', 'e', 10)
+    assert SmallCache.get('c') is None
+    clock.now += 15
+    assert SmallCache.get('a') == 'A'
+    assert SmallCache.get('d') is None
+    assert len(SmallCache._mobj) <= SmallCache._maxsize
+
+
+def test_delete(clock):
+    SmallCache.add('a', 1, 10)
+    SmallCache.delete('a')
+    SmallCache.delete('a')
+    assert SmallCache.get('a') is None
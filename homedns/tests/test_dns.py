@@ -0,0 +1,377 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+from dnslib import DNSRecord, DNSQuestion, EDNS0, RR, QTYPE, A, AAAA, CNAME
+
+from .. import dns
+from ..dns import (
+    parse_question, pack_rr, pack_reply, ttl_offsets, recvall,
+    UDPUpstream, TCPUpstream,
+)
+
+
+def reply_of(data, ip='1.2.3.4', count=1):
+    request = DNSRecord.parse(data)
+    reply = request.reply()
+    for i in range(count):
+        reply.add_answer(RR(request.q.qname, rdata=A(ip), ttl=60))
+    return reply
+
+
+@pytest.mark.parametrize('name, qtype', [
+    ('www.example.com', 'A'),
+    ('WwW.ExAmple.COM', 'AAAA'),
+    ('example.com.', 'MX'),
+    ('.', 'NS'),
+])
+def test_parse_question(name, qtype):
+    request = DNSRecord.question(name, qtype)
+    data = request.pack()
+    txid, qname, qt, qclass, q_end = parse_question(data)
+    assert txid == request.header.id
+    assert qname == DNSRecord.question(name.lower(), qtype).pack()[12:-4]
+    assert qt == getattr(QTYPE, qtype)
+    assert qclass == 1
+    assert q_end == len(data)
+
+
+def test_parse_question_case():
+    data = DNSRecord.question('WWW.Example.com').pack()
+    other = DNSRecord.question('www.example.COM').pack()
+    assert parse_question(data)[1:4] == parse_question(other)[1:4]
+
+
+def test_parse_question_error():
+    data = DNSRecord.question('www.example.com').pack()
+    with pytest.raises(ValueError):
+        # two questions
+        parse_question(data[:5] + b'\x02' + data[6:])
+    with pytest.raises(ValueError):
+        # compressed name
+        parse_question(data[:12] + b'\xc0\x0c' + data[-4:])
+    with pytest.raises(Exception):
+        parse_question(data[:20])
+
+
+@pytest.mark.parametrize('qname, records', [
+    ('www.example.com', [('www.example.com', A('1.1.1.1'))]),
+    ('www.example.com', [
+        ('www.example.com', A('1.1.1.%s' % i)) for i in range(20)
+    ]),
+    ('WWW.Example.com', [('www.example.com', A('1.1.1.1'))]),
+    ('www.example.com', [
+        ('www.example.com', CNAME('example.com')),
+        ('example.com', A('2.2.2.2')),
+        ('example.com', AAAA('::1')),
+    ]),
+])
+def test_pack_reply(qname, records):
+    request = DNSRecord.question(qname)
+    reply = request.reply()
+    for name, rdata in records:
+        rtype = getattr(QTYPE, rdata.__class__.__name__)
+        reply.add_answer(RR(name, rtype, rdata=rdata, ttl=300))
+    data = request.pack()
+    packed = pack_reply(reply.header, data[12:], [pack_rr(r) for r in reply.rr])
+    expected = reply.pack()
+    if all(name == qname for name, _ in records):
+        # owner name of question is compressed as dnslib does
+        assert len(packed) == len(expected)
+    assert packed[:12] == expected[:12]
+    parsed = DNSRecord.parse(bytes(packed))
+    assert parsed.q == request.q
+    assert parsed.rr == DNSRecord.parse(expected).rr
+
+
+def test_ttl_offsets():
+    request = DNSRecord.question('www.example.com')
+    request.add_ar(EDNS0(udp_len=4096))
+    reply = request.reply()
+    reply.add_answer(
+        RR('www.example.com', QTYPE.CNAME, rdata=CNAME('example.com'), ttl=100)
+    )
+    reply.add_answer(RR('example.com', rdata=A('1.1.1.1'), ttl=200))
+    reply.add_auth(RR('example.com', QTYPE.AAAA, rdata=AAAA('::1'), ttl=300))
+    data = reply.pack()
+    q_end = parse_question(data)[4]
+    offsets = ttl_offsets(data, q_end)
+    ttls = [struct.unpack_from('!I', data, offset)[0] for offset in offsets]
+    # OPT record is skipped
+    assert ttls == [100, 200, 300]
+
+
+def test_recvall():
+    a, b = socket.socketpair()
+    with a, b:
+        b.sendall(b'abc')
+        b.sendall(b'defg')
+        data = recvall(a, 5)
+        assert isinstance(data, bytearray)
+        assert data == b'abcde'
+        buf = bytearray(4)
+        assert recvall(a, 2, buf) is buf
+        assert buf[:2] == b'fg'
+        b.close()
+        with pytest.raises(ConnectionError):
+            recvall(a, 1)
+
+
+class FakeUDPServer(object):
+    """ answer queries, or keep silent """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.silent = False
+        self.spoof = False
+        self.count = 1
+        self.ports = set()
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            self.ports.add(addr[1])
+            if self.silent:
+                continue
+            try:
+                if self.spoof:
+                    # same ID with another question
+                    request = DNSRecord.parse(data)
+                    fake = DNSRecord.question('spoof.example.com')
+                    fake.header.id = request.header.id
+                    self.sock.sendto(reply_of(fake.pack(), '6.6.6.6').pack(), addr)
+                self.sock.sendto(reply_of(data, count=self.count).pack(), addr)
+            except OSError:
+                # closed by test
+                return
+
+    def close(self):
+        self.sock.close()
+
+
+class FakeTCPServer(object):
+    """ answer queries, close connection after per_conn queries """
+    def __init__(self, per_conn=2):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.per_conn = per_conn
+        self.silent = False
+        # names not answered
+        self.ignore = set()
+        self.conns = 0
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            self.conns += 1
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def handle(self, conn):
+        with conn:
+            try:
+                for _ in range(self.per_conn):
+                    length = struct.unpack('!H', recvall(conn, 2))[0]
+                    data = recvall(conn, length)
+                    if self.silent:
+                        continue
+                    if str(DNSRecord.parse(data).q.qname) in self.ignore:
+                        continue
+                    response = reply_of(data).pack()
+                    conn.sendall(struct.pack('!H', len(response)) + response)
+            except OSError:
+                pass
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def udp_server():
+    server = FakeUDPServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def tcp_server():
+    server = FakeTCPServer()
+    yield server
+    server.close()
+
+
+def query_many(upstream, count=20):
+    errors = []
+
+    def query(index):
+        request = DNSRecord.question('h%s.example.com' % index)
+        # same client ID for every query
+        request.header.id = 7
+        try:
+            reply = DNSRecord.parse(upstream.query(request.pack(), timeout=2))
+        except Exception as err:
+            errors.append(err)
+            return
+        if reply.header.id != 7 or reply.q != request.q:
+            errors.append(reply)
+
+    threads = [threading.Thread(target=query, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def test_udp_upstream(udp_server):
+    upstream = UDPUpstream('127.0.0.1', udp_server.port)
+    assert query_many(upstream) == []
+    assert upstream._pending == {}
+    ports = {sock.getsockname()[1] for sock in upstream.socks}
+    assert len(ports) == len(upstream.socks)
+
+
+def test_udp_upstream_timeout(udp_server):
+    upstream = UDPUpstream('127.0.0.1', udp_server.port)
+    udp_server.silent = True
+    with pytest.raises(socket.timeout):
+        upstream.query(DNSRecord.question('example.com').pack(), timeout=0.2)
+    assert upstream._pending == {}
+    udp_server.silent = False
+    assert query_many(upstream, 2) == []
+
+
+def test_udp_upstream_spoof(udp_server):
+    upstream = UDPUpstream('127.0.0.1', udp_server.port)
+    udp_server.spoof = True
+    data = upstream.query(DNSRecord.question('www.example.com').pack(), timeout=2)
+    reply = DNSRecord.parse(data)
+    assert str(reply.q.qname) == 'www.example.com.'
+    assert str(reply.rr[0].rdata) == '1.2.3.4'
+
+
+def test_udp_upstream_large(udp_server):
+    upstream = UDPUpstream('127.0.0.1', udp_server.port)
+    udp_server.count = 600
+    data = upstream.query(DNSRecord.question('example.com').pack(), timeout=2)
+    assert len(data) > 8192
+    assert len(DNSRecord.parse(data).rr) == 600
+
+
+def test_udp_upstream_rotate(udp_server, monkeypatch):
+    monkeypatch.setattr(dns, 'UDP_SOCKET_QUERIES', 2)
+    upstream = UDPUpstream('127.0.0.1', udp_server.port, count=1)
+    first = upstream.socks[0]
+    for i in range(6):
+        assert query_many(upstream, 1) == []
+    # new source port every 2 queries
+    assert len(udp_server.ports) == 3
+    assert upstream.socks[0] is not first
+    assert list(upstream._usage) == upstream.socks
+    for i in range(20):
+        if first.fileno() < 0:
+            break
+        time.sleep(0.05)
+    assert first.fileno() < 0
+
+
+def test_udp_upstream_questions(udp_server):
+    upstream = UDPUpstream('127.0.0.1', udp_server.port)
+    request = DNSRecord.question('www.example.com')
+    request.add_question(DNSQuestion('example.com'))
+    data = upstream.query(request.pack(), timeout=2)
+    reply = DNSRecord.parse(data)
+    assert reply.header.id == request.header.id
+    assert str(reply.rr[0].rdata) == '1.2.3.4'
+
+
+def test_udp_upstream_closed(udp_server):
+    port = udp_server.port
+    udp_server.close()
+    upstream = UDPUpstream('127.0.0.1', port)
+    # ICMP port unreachable is ignored by reader
+    for i in range(2):
+        with pytest.raises(socket.timeout):
+            upstream.query(DNSRecord.question('example.com').pack(), timeout=0.2)
+
+
+def test_tcp_upstream(tcp_server):
+    upstream = TCPUpstream('127.0.0.1', tcp_server.port)
+    # server closes connection after 2 queries, connect again
+    for i in range(5):
+        assert query_many(upstream, 1) == []
+    assert tcp_server.conns == 3
+
+
+def test_tcp_upstream_pipeline():
+    server = FakeTCPServer(per_conn=100)
+    try:
+        upstream = TCPUpstream('127.0.0.1', server.port)
+        assert query_many(upstream, 50) == []
+        assert server.conns == 1
+    finally:
+        server.close()
+
+
+def test_tcp_upstream_timeout(tcp_server):
+    upstream = TCPUpstream('127.0.0.1', tcp_server.port)
+    tcp_server.silent = True
+    with pytest.raises(socket.timeout):
+        upstream.query(DNSRecord.question('example.com').pack(), timeout=0.2)
+    assert upstream._pending == {}
+    # silent connection is dropped
+    assert upstream.sock is None
+    tcp_server.silent = False
+    assert query_many(upstream, 1) == []
+    assert tcp_server.conns == 2
+
+
+def test_tcp_upstream_timeout_one():
+    server = FakeTCPServer(per_conn=100)
+    try:
+        upstream = TCPUpstream('127.0.0.1', server.port)
+        server.ignore.add('slow.example.com.')
+        slow = threading.Thread(target=lambda: pytest.raises(
+            socket.timeout, upstream.query,
+            DNSRecord.question('slow.example.com').pack(), timeout=0.5,
+        ))
+        slow.start()
+        # connection keeps answering other queries
+        for i in range(10):
+            assert query_many(upstream, 1) == []
+            time.sleep(0.1)
+        slow.join()
+        assert upstream.sock is not None
+        assert upstream._pending == {}
+        assert query_many(upstream, 5) == []
+        assert server.conns == 1
+    finally:
+        server.close()
+
+
+def test_tcp_upstream_refused():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    upstream = TCPUpstream('127.0.0.1', port)
+    with pytest.raises(OSError):
+        upstream.query(DNSRecord.question('example.com').pack(), timeout=0.5)
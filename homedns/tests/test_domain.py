@@ -0,0 +1,145 @@
+import json
+
+from dnslib import DNSLabel
+
+from .. import domain as domain_module
+from ..domain import Domain, HostDomain
+from ..loader import TxtLoader, JsonLoader
+
+
+RECORDS = {
+    'A': {
+        '@': ['127.0.0.1'],
+        'ns1': ['127.0.0.2', '127.0.0.3'],
+    },
+    'AAAA': {
+        '@': ['::1'],
+    },
+    'CNAME': {
+        'www': ['@'],
+        'vps': ['@vps.example.net'],
+    },
+}
+
+
+def create(tmp_path, records):
+    json_file = tmp_path / 'mylocal.home.json'
+    json_file.write_text(json.dumps(records), encoding='utf-8')
+    domain = Domain('mylocal.home')
+    domain.create(JsonLoader(str(json_file)))
+    return domain
+
+
+def rdatas(answers):
+    return sorted(str(answer[0].rdata) for answer in answers)
+
+
+def test_answers(tmp_path):
+    domain = create(tmp_path, RECORDS)
+    answers = domain.answers(DNSLabel('NS1.MyLocal.home.'), 'A')
+    assert rdatas(answers) == ['127.0.0.2', '127.0.0.3']
+    # built once
+    assert domain.answers(DNSLabel('ns1.mylocal.home.'), 'A') is answers
+    assert rdatas(domain.answers(DNSLabel('mylocal.home.'), 'AAAA')) == ['::1']
+    assert domain.answers(DNSLabel('none.mylocal.home.'), 'A') == []
+    assert len(domain._answers) == 2
+
+
+def test_outside_alias(tmp_path):
+    domain = create(tmp_path, RECORDS)
+    www = domain.answers(DNSLabel('www.mylocal.home.'), 'CNAME')
+    assert [answer[1] for answer in www] == [False]
+    vps = domain.answers(DNSLabel('vps.mylocal.home.'), 'CNAME')
+    assert [answer[1] for answer in vps] == [True]
+
+
+def test_update(tmp_path):
+    domain = create(tmp_path, RECORDS)
+    assert rdatas(domain.answers(DNSLabel('mylocal.home.'), 'A')) == ['127.0.0.1']
+    json_file = tmp_path / 'mylocal.home.json'
+    json_file.write_text(json.dumps({'A': {'@': ['10.0.0.1']}}), encoding='utf-8')
+    domain.update()
+    assert rdatas(domain.answers(DNSLabel('mylocal.home.'), 'A')) == ['10.0.0.1']
+    assert domain.answers(DNSLabel('ns1.mylocal.home.'), 'A') == []
+
+
+def test_update_error(tmp_path):
+    domain = create(tmp_path, RECORDS)
+    json_file = tmp_path / 'mylocal.home.json'
+    json_file.write_text('{"A": ', encoding='utf-8')
+    domain.update()
+    assert rdatas(domain.answers(DNSLabel('ns1.mylocal.home.'), 'A')) == [
+        '127.0.0.2', '127.0.0.3',
+    ]
+    assert domain.isSubdomain(DNSLabel('www.mylocal.home.'))
+
+
+def test_hosts(tmp_path):
+    hosts_file = tmp_path / 'hosts'
+    hosts_file.write_text(
+        '# hosts\n1.1.1.1 www.example.com\n::1 www.example.com\n',
+        encoding='utf-8',
+    )
+    domain = HostDomain('hosts')
+    domain.create(TxtLoader(str(hosts_file)))
+    assert domain.inDomain(DNSLabel('WWW.example.com.'))
+    answers = domain.answers(DNSLabel('www.example.com.'), 'A')
+    assert rdatas(answers) == ['1.1.1.1', '::1']
+
+
+def test_hosts_parse(tmp_path):
+    hosts_file = tmp_path / 'hosts'
+    hosts_file.write_text(
+        '# comment\n'
+        '\n'
+        '  \t\n'
+        '1.1.1.1\ta.example.com # inline comment\n'
+        '1.1.1.1 b.example.com\n'
+        '@c.example.net c.example.com\n',
+        encoding='utf-8',
+    )
+    domain = HostDomain('hosts')
+    domain.create(TxtLoader(str(hosts_file)))
+    assert sorted(domain.records) == [
+        'a.example.com.', 'b.example.com.', 'c.example.com.',
+    ]
+    # same address shares one rdata
+    a = domain.records['a.example.com.'][0]
+    assert a is domain.records['b.example.com.'][0]
+    assert str(a) == '1.1.1.1'
+    cname = domain.answers(DNSLabel('c.example.com.'), 'A')
+    assert [(str(answer[0].rdata), answer[1]) for answer in cname] == [
+        ('c.example.net.', True),
+    ]
+
+
+def test_hosts_memo(tmp_path, monkeypatch):
+    monkeypatch.setattr(domain_module, 'ANSWER_CACHE_SIZE', 2)
+    hosts_file = tmp_path / 'hosts'
+    hosts_file.write_text(
+        ''.join('1.1.1.%s h%s.example.com\n' % (i, i) for i in range(3)),
+        encoding='utf-8',
+    )
+    domain = HostDomain('hosts')
+    domain.create(TxtLoader(str(hosts_file)))
+    # search ignores query type, one memo for every type
+    answers = domain.answers(DNSLabel('h0.example.com.'), 'A')
+    assert domain.answers(DNSLabel('h0.example.com.'), 'AAAA') is answers
+    assert domain.answers(DNSLabel('h1.example.com.'), 'MX')
+    assert domain.answers(DNSLabel('h2.example.com.'), 'A')
+    assert len(domain._answers) == 2
+
+
+def test_hosts_update_error(tmp_path):
+    hosts_file = tmp_path / 'hosts'
+    hosts_file.write_text('1.1.1.1 www.example.com\n', encoding='utf-8')
+    domain = HostDomain('hosts')
+    assert domain.create(TxtLoader(str(hosts_file)))
+    answers = domain.answers(DNSLabel('www.example.com.'), 'A')
+    # bad address in new hosts file
+    hosts_file.write_text('1.1.1 www.example.com\n', encoding='utf-8')
+    domain.update()
+    assert domain.answers(DNSLabel('www.example.com.'), 'A') is answers
+    hosts_file.unlink()
+    domain.update()
+    assert rdatas(domain.answers(DNSLabel('www.example.com.'), 'A')) == ['1.1.1.1']
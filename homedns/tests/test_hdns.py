@@ -0,0 +1,142 @@
+import logging
+
+import pytest
+
+from .. import globalvars
+from .. import hdns
+
+
+class Stop(Exception):
+    pass
+
+
+class Clock(object):
+    """ replace time module of hdns, sleep moves time forward """
+    def __init__(self, now, stop):
+        self.now = now
+        self.stop = stop
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+        if self.now > self.stop:
+            raise Stop()
+
+
+class Loader(object):
+    def __init__(self, local, last_update=0):
+        self.local = local
+        self.last_update = last_update
+        self.cache_updated = False
+
+    def lastUpdateTime(self):
+        return self.last_update
+
+    def isCacheUpdated(self):
+        return self.cache_updated
+
+
+class Updater(object):
+    def __init__(self, clock, loader, need=True):
+        self.clock = clock
+        self.loader = loader
+        self.need = need
+        self.checks = []
+        self.updates = []
+
+    def isNeedUpdate(self, refresh):
+        self.checks.append(self.clock.now)
+        return self.need
+
+    def async_update(self, cache=False):
+        self.updates.append((self.clock.now, cache) if cache else self.clock.now)
+        if self.loader:
+            self.loader.last_update = self.clock.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(1000, 1000 + 700)
+    monkeypatch.setattr(hdns, 'time', clock)
+    # set by init_config
+    monkeypatch.setattr(hdns, 'logger', logging.getLogger('homedns.hdns'), raising=False)
+    return clock
+
+
+def test_next_refresh(clock):
+    local = Updater(clock, Loader(True))
+    assert hdns.next_refresh(local, 300, 60) == 1060
+    remote = Updater(clock, Loader(False, last_update=900))
+    assert hdns.next_refresh(remote, 300, 60) == 1200
+    remote.loader.last_update = 0
+    assert hdns.next_refresh(remote, 300, 60) == 1060
+    assert hdns.next_refresh(Updater(clock, None), 300, 60) == 1060
+    # worker process checks cache every interval
+    remote.loader.last_update = 900
+    assert hdns.next_refresh(remote, 300, 60, download=False) == 1060
+
+
+def test_refresh_loop(clock, monkeypatch):
+    local = Updater(clock, Loader(True), need=False)
+    remote = Updater(clock, Loader(False, last_update=1000))
+    never = Updater(clock, Loader(False))
+    monkeypatch.setattr(globalvars, 'rules', [
+        ('remote', remote, [], 300),
+        ('never', never, [], 0),
+    ], raising=False)
+    monkeypatch.setattr(globalvars, 'local_domains', {
+        'local': {'domain': local, 'refresh': 10},
+    }, raising=False)
+    with pytest.raises(Stop):
+        hdns.refresh_loop(interval=60)
+    # local file is checked every interval
+    assert local.checks == [1000 + 60 * i for i in range(1, 12)]
+    assert local.updates == []
+    # remote one is checked after refresh seconds from last update
+    assert remote.checks == [1300, 1600]
+    assert remote.updates == [1300, 1600]
+    assert never.checks == []
+
+
+def test_refresh_error(clock, monkeypatch):
+    broken = Updater(clock, Loader(True))
+
+    def error(refresh):
+        broken.checks.append(clock.now)
+        raise IOError('broken')
+
+    broken.isNeedUpdate = error
+    monkeypatch.setattr(globalvars, 'rules', [], raising=False)
+    monkeypatch.setattr(globalvars, 'local_domains', {
+        'broken': {'domain': broken, 'refresh': 10},
+    }, raising=False)
+    with pytest.raises(Stop):
+        hdns.refresh_loop(interval=300)
+    # still checked again after error
+    assert broken.checks == [1300, 1600]
+
+
+def test_refresh_loop_worker(clock, monkeypatch):
+    local = Updater(clock, Loader(True), need=False)
+    remote = Updater(clock, Loader(False, last_update=1000))
+    monkeypatch.setattr(globalvars, 'rules', [
+        ('remote', remote, [], 300),
+    ], raising=False)
+    monkeypatch.setattr(globalvars, 'local_domains', {
+        'local': {'domain': local, 'refresh': 10},
+    }, raising=False)
+    clock.stop = 1000 + 200
+
+    def cache_updated():
+        # cache is written by main process at 1100
+        return clock.now > 1100 and remote.loader.last_update < 1100
+
+    remote.loader.isCacheUpdated = cache_updated
+    with pytest.raises(Stop):
+        hdns.refresh_loop(interval=60, download=False)
+    assert local.checks == [1060, 1120, 1180]
+    # never download, reload from cache once
+    assert remote.checks == []
+    assert remote.updates == [(1120, True)]
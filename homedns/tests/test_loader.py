@@ -0,0 +1,97 @@
+import base64
+import os
+import threading
+
+import pytest
+
+from .. import globalvars
+from ..loader import TxtLoader
+
+
+RULES = ''.join('||ads%s.example.com\n' % i for i in range(100)).encode('utf-8')
+
+
+def wrap(data, width, newline=b'\n'):
+    text = base64.b64encode(data)
+    lines = [text[i:i + width] for i in range(0, len(text), width)]
+    return newline.join(lines) + newline
+
+
+@pytest.fixture
+def loader(tmp_path):
+    return TxtLoader(str(tmp_path / 'test.rules'))
+
+
+@pytest.mark.parametrize('data', [
+    # openssl
+    wrap(RULES, 64),
+    # GNU base64
+    base64.encodebytes(RULES),
+    wrap(RULES, 76, b'\r\n'),
+    # empty last line
+    base64.encodebytes(RULES) + b'\n',
+    # one line
+    base64.b64encode(RULES),
+    base64.b64encode(b'||example.com\n'),
+    base64.b64encode(b'||example.com\n').decode('ascii'),
+])
+def test_is_base64(loader, data):
+    assert loader.is_base64(data)
+
+
+@pytest.mark.parametrize('data', [
+    RULES,
+    RULES.decode('utf-8'),
+    b'',
+    b'\n\n',
+    b'example',
+    # different width
+    wrap(RULES, 64)[:64] + b'\n' + wrap(RULES, 76),
+    # short last line of whole data
+    base64.b64encode(b'||example.com\n')[:-1],
+])
+def test_not_base64(loader, data):
+    assert not loader.is_base64(data)
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    monkeypatch.setattr(globalvars, 'config_dir', str(tmp_path), raising=False)
+    return TxtLoader('http://example.com/test.rules')
+
+
+def test_write_cache(remote):
+    texts = [('%s\n' % i) * 10000 for i in range(10)]
+    threads = [
+        threading.Thread(target=remote._write_cache, args=(text,))
+        for text in texts
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(remote.cache, encoding='utf-8') as f:
+        assert f.read() in texts
+    assert os.listdir(os.path.dirname(remote.cache)) == ['test.rules']
+
+
+def test_write_cache_error(remote):
+    # cache path could not be replaced
+    os.mkdir(remote.cache)
+    os.mkdir(os.path.join(remote.cache, 'busy'))
+    remote._write_cache('||example.com\n')
+    assert os.listdir(os.path.dirname(remote.cache)) == ['test.rules']
+    assert os.path.isdir(remote.cache)
+
+
+def test_cache_updated(remote):
+    assert not remote.isCacheUpdated()
+    remote._write_cache('||example.com\n')
+    assert remote.isCacheUpdated()
+    with remote.open(cache=True) as f:
+        assert f.read() == '||example.com\n'
+    assert not remote.isCacheUpdated()
+    # written by other process
+    mtime = os.stat(remote.cache).st_mtime
+    os.utime(remote.cache, (mtime + 10, mtime + 10))
+    assert remote.isCacheUpdated()
@@ -0,0 +1,157 @@
+import json
+import time
+
+import pytest
+from dnslib import DNSRecord, EDNS0
+
+from .. import globalvars
+from .. import lookup
+from ..cache import DNSCache
+from ..domain import Domain, HostDomain
+from ..loader import TxtLoader, JsonLoader
+
+
+HOSTS = """\
+# test hosts
+1.1.1.1 www.example.com
+2.2.2.2 www.example.com
+""" + ''.join('10.0.0.%s many.example.com\n' % i for i in range(40))
+
+
+class Handler(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_data(self, data):
+        self.sent.append(bytes(data))
+
+
+@pytest.fixture
+def local(tmp_path, monkeypatch):
+    hosts_file = tmp_path / 'hosts'
+    hosts_file.write_text(HOSTS, encoding='utf-8')
+    domain = HostDomain('hosts')
+    domain.create(TxtLoader(str(hosts_file)))
+    monkeypatch.setattr(globalvars, 'config', {
+        'server': {'search': ['local']},
+        'smartdns': {'hack_srv': []},
+    }, raising=False)
+    monkeypatch.setattr(globalvars, 'local_domains', {
+        'hosts': {'domain': domain, 'refresh': 0},
+    }, raising=False)
+    monkeypatch.setattr(globalvars, 'dig', False, raising=False)
+    DNSCache.clear()
+    yield domain
+    DNSCache.clear()
+
+
+def ask(request):
+    handler = Handler()
+    lookup.dns_response(handler, request.pack())
+    assert len(handler.sent) == 1
+    return handler.sent[0]
+
+
+def test_local(local):
+    request = DNSRecord.question('www.example.com')
+    reply = DNSRecord.parse(ask(request))
+    assert reply.header.id == request.header.id
+    assert reply.q == request.q
+    assert sorted(str(r.rdata) for r in reply.rr) == ['1.1.1.1', '2.2.2.2']
+
+
+def test_cache(local):
+    first = DNSRecord.question('www.example.com')
+    data = ask(first)
+    # answered from cache without local records
+    local.records.clear()
+    second = DNSRecord.question('www.example.com')
+    cached = ask(second)
+    assert len(cached) == len(data)
+    reply = DNSRecord.parse(cached)
+    assert reply.header.id == second.header.id
+    assert reply.rr == DNSRecord.parse(data).rr
+    # not cached without answers
+    nothing = DNSRecord.question('none.example.com')
+    assert DNSRecord.parse(ask(nothing)).rr == []
+    assert len(DNSCache._mobj) == 1
+
+
+def test_cache_ttl(local, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    request = DNSRecord.question('www.example.com')
+    request.add_ar(EDNS0(udp_len=4096))
+    data = ask(request)
+    ttl = DNSRecord.parse(data).rr[0].ttl
+    local.records.clear()
+    now[0] += 10.5
+    reply = DNSRecord.parse(ask(request))
+    assert [r.ttl for r in reply.rr] == [ttl - 10] * 2
+    assert reply.ar == DNSRecord.parse(data).ar
+    # zero at expire time
+    now[0] += ttl - 10.5
+    reply = DNSRecord.parse(ask(request))
+    assert [r.ttl for r in reply.rr] == [0] * 2
+
+
+def test_cache_case(local):
+    first = DNSRecord.question('www.example.com')
+    data = ask(first)
+    # name differs only in case is answered from cache
+    local.records.clear()
+    second = DNSRecord.question('WWW.Example.COM')
+    cached = ask(second)
+    assert len(cached) == len(data)
+    reply = DNSRecord.parse(cached)
+    assert reply.header.id == second.header.id
+    # question of request is copied into cached reply
+    question = second.pack()[12:]
+    assert cached[12:12 + len(question)] == question
+    assert str(reply.q.qname) == 'WWW.Example.COM.'
+    assert reply.rr == DNSRecord.parse(data).rr
+
+
+def test_local_case(local):
+    request = DNSRecord.question('WWW.Example.COM')
+    reply = DNSRecord.parse(ask(request))
+    assert reply.q == request.q
+    assert sorted(str(r.rdata) for r in reply.rr) == ['1.1.1.1', '2.2.2.2']
+
+
+def test_large_reply(local):
+    request = DNSRecord.question('many.example.com')
+    data = ask(request)
+    reply = DNSRecord.parse(data)
+    assert len(reply.rr) == 40
+    assert data == reply.pack()
+
+
+@pytest.fixture
+def alias(tmp_path, local):
+    # 25 A records of other owner than question, over 512 bytes uncompressed
+    json_file = tmp_path / 'alias.home.json'
+    json_file.write_text(json.dumps({
+        'A': {'@': ['10.0.0.%s' % i for i in range(25)]},
+        'CNAME': {'www': ['@']},
+    }), encoding='utf-8')
+    domain = Domain('alias.home')
+    domain.create(JsonLoader(str(json_file)))
+    globalvars.local_domains['alias'] = {'domain': domain, 'refresh': 0}
+    return domain
+
+
+@pytest.mark.parametrize('edns', [False, True])
+def test_large_reply_compressed(alias, edns):
+    request = DNSRecord.question('www.alias.home')
+    if edns:
+        request.add_ar(EDNS0(udp_len=4096))
+    data = ask(request)
+    reply = DNSRecord.parse(data)
+    assert len(reply.rr) == 26
+    assert len(data) <= lookup.UDP_SIZE
+    # reply cached for any request fits UDP request without EDNS
+    alias.records.clear()
+    cached = ask(DNSRecord.question('www.alias.home'))
+    assert len(cached) == len(data)
+    assert DNSRecord.parse(cached).rr == reply.rr
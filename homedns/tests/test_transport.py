@@ -0,0 +1,239 @@
+import socket
+import struct
+import threading
+import time
+
+import netaddr
+import pytest
+from dnslib import DNSRecord
+
+from .. import globalvars
+from .. import transport
+from ..cache import DNSCache
+from ..dns import recvall
+from ..domain import HostDomain
+from ..loader import TxtLoader
+from ..transport import (
+    is_allowed_host,
+    ThreadingUDPServer, ThreadingTCPServer,
+    UDPRequestHandler, TCPRequestHandler,
+)
+
+
+ALLOWED_HOSTS = [
+    '127.0.0.1',
+    '192.168.1.0/24',
+    '192.168.2.0/24',
+    '10.0.0.1-10',
+    '172.16.*.*',
+    '::1',
+]
+
+
+@pytest.fixture
+def allowed(monkeypatch):
+    """ same as init_config """
+    allowed_hosts = netaddr.IPSet()
+    allowed_ips = set()
+    for hosts in ALLOWED_HOSTS:
+        if '*' in hosts or '-' in hosts:
+            allowed_hosts.add(netaddr.IPGlob(hosts))
+        elif '/' in hosts:
+            allowed_hosts.add(netaddr.IPNetwork(hosts))
+        else:
+            allowed_hosts.add(hosts)
+            allowed_ips.add(hosts)
+    monkeypatch.setattr(globalvars, 'allowed_hosts', allowed_hosts, raising=False)
+    monkeypatch.setattr(
+        globalvars, 'allowed_ips', frozenset(allowed_ips), raising=False)
+    monkeypatch.setattr(globalvars, 'allowed_ranges', [
+        (r.first, r.last) for r in allowed_hosts.iter_ipranges()
+        if r.version == 4
+    ], raising=False)
+    return allowed_hosts
+
+
+@pytest.mark.parametrize('ip, expected', [
+    ('127.0.0.1', True),
+    ('127.0.0.0', False),
+    ('127.0.0.2', False),
+    ('192.168.0.255', False),
+    ('192.168.1.0', True),
+    ('192.168.1.255', True),
+    ('192.168.2.0', True),
+    ('192.168.2.255', True),
+    ('192.168.3.0', False),
+    ('10.0.0.0', False),
+    ('10.0.0.1', True),
+    ('10.0.0.10', True),
+    ('10.0.0.11', False),
+    ('172.15.255.255', False),
+    ('172.16.0.0', True),
+    ('172.16.255.255', True),
+    ('172.17.0.0', False),
+    ('0.0.0.0', False),
+    ('255.255.255.255', False),
+    ('::1', True),
+    ('::2', False),
+])
+def test_is_allowed_host(allowed, ip, expected):
+    assert is_allowed_host(ip) == expected
+
+
+def test_same_as_ipset(allowed):
+    for r in allowed.iter_ipranges():
+        if r.version != 4:
+            continue
+        for value in (r.first - 1, r.first, r.first + 1, r.last - 1, r.last, r.last + 1):
+            ip = str(netaddr.IPAddress(value))
+            assert is_allowed_host(ip) == (ip in allowed), ip
+
+
+def test_nothing_allowed(monkeypatch):
+    monkeypatch.setattr(globalvars, 'allowed_hosts', netaddr.IPSet(), raising=False)
+    monkeypatch.setattr(globalvars, 'allowed_ips', frozenset(), raising=False)
+    monkeypatch.setattr(globalvars, 'allowed_ranges', [], raising=False)
+    assert not is_allowed_host('127.0.0.1')
+    assert not is_allowed_host('::1')
+
+
+@pytest.fixture
+def servers(tmp_path, monkeypatch, allowed):
+    hosts_file = tmp_path / 'hosts'
+    hosts_file.write_text('1.1.1.1 www.example.com\n', encoding='utf-8')
+    domain = HostDomain('hosts')
+    domain.create(TxtLoader(str(hosts_file)))
+    monkeypatch.setattr(globalvars, 'config', {
+        'server': {'search': ['local']},
+        'smartdns': {'hack_srv': []},
+    }, raising=False)
+    monkeypatch.setattr(globalvars, 'local_domains', {
+        'hosts': {'domain': domain, 'refresh': 0},
+    }, raising=False)
+    monkeypatch.setattr(globalvars, 'dig', False, raising=False)
+    DNSCache.clear()
+    udp = ThreadingUDPServer(('127.0.0.1', 0), UDPRequestHandler)
+    tcp = ThreadingTCPServer(('127.0.0.1', 0), TCPRequestHandler)
+    for server in (udp, tcp):
+        t = threading.Thread(target=server.serve_forever, args=(0.05,))
+        t.daemon = True
+        t.start()
+    yield udp.server_address, tcp.server_address
+    for server in (udp, tcp):
+        server.shutdown()
+        server.server_close()
+    DNSCache.clear()
+
+
+def udp_query(address, name):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(2)
+        sock.sendto(DNSRecord.question(name).pack(), address)
+        return DNSRecord.parse(sock.recv(4096))
+
+
+def tcp_query(sock, name):
+    data = DNSRecord.question(name).pack()
+    sock.sendall(struct.pack('!H', len(data)) + data)
+    length = struct.unpack('!H', recvall(sock, 2))[0]
+    return DNSRecord.parse(recvall(sock, length))
+
+
+def test_udp_server(servers):
+    udp_address, _ = servers
+    results = []
+
+    def query(index):
+        reply = udp_query(udp_address, 'www.example.com')
+        results.append(str(reply.rr[0].rdata))
+
+    threads = [threading.Thread(target=query, args=(i,)) for i in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ['1.1.1.1'] * 50
+
+
+def test_tcp_server(servers, monkeypatch):
+    monkeypatch.setattr(transport, 'TCP_TIMEOUT', 0.2)
+    _, tcp_address = servers
+    with socket.create_connection(tcp_address, timeout=2) as sock:
+        reply = tcp_query(sock, 'www.example.com')
+        assert str(reply.rr[0].rdata) == '1.1.1.1'
+    # idle client is closed by server
+    with socket.create_connection(tcp_address, timeout=2) as sock:
+        assert sock.recv(1) == b''
+
+
+def test_tcp_idle_clients(servers, monkeypatch):
+    monkeypatch.setattr(transport, 'TCP_TIMEOUT', 3)
+    udp_address, tcp_address = servers
+    idle = []
+    try:
+        # more idle clients than all workers
+        for i in range(transport.REQUEST_WORKERS + 2):
+            idle.append(socket.create_connection(tcp_address, timeout=2))
+            # not beyond listen backlog of server
+            time.sleep(0.01)
+        time.sleep(0.1)
+        # UDP requests are not blocked by them
+        start = time.monotonic()
+        reply = udp_query(udp_address, 'www.example.com')
+        assert str(reply.rr[0].rdata) == '1.1.1.1'
+        assert time.monotonic() - start < 1
+    finally:
+        for sock in idle:
+            sock.close()
+
+
+class Stop(Exception):
+    pass
+
+
+class FakeServer(transport.PoolMixIn):
+    def __init__(self, pool):
+        self.request_pool = pool
+        self.finished = []
+        self.closed = []
+
+    def finish_request(self, request, client_address):
+        if request == 'stop':
+            raise Stop()
+        self.finished.append(request)
+
+    def handle_error(self, request, client_address):
+        raise
+
+    def shutdown_request(self, request):
+        self.closed.append(request)
+
+
+@pytest.fixture
+def pool():
+    """ small backlog without worker thread """
+    pool = transport.RequestPool('test', 0, backlog=3)
+    pool.workers.append(None)
+    return pool
+
+
+def test_backlog_full(pool):
+    server = FakeServer(pool)
+    for request in 'abcde':
+        server.process_request(request, ('127.0.0.1', 1000))
+    # the oldest ones are dropped
+    assert server.closed == ['a', 'b']
+    assert [pool.queue.get_nowait()[2] for _ in range(3)] == ['c', 'd', 'e']
+
+
+def test_stale_request(pool):
+    server = FakeServer(pool)
+    address = ('127.0.0.1', 1000)
+    now = time.monotonic()
+    pool.queue.put((now - transport.REQUEST_STALE - 1, server, 'old', address))
+    pool.queue.put((now, server, 'new', address))
+    pool.queue.put((now, server, 'stop', address))
+    with pytest.raises(Stop):
+        pool.worker()
+    assert server.finished == ['new']
+    assert server.closed == ['old', 'new', 'stop']
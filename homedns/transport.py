@@ -2,20 +2,125 @@
 # -*- encoding:utf-8 -*-
 
 import datetime
-import binascii
 import logging
 import logging.handlers
 import traceback
+import struct
 import socket
 import socketserver
+import threading
+import queue
+import time
+from bisect import bisect_right
 
 from . import globalvars
 from . import lookup
+from .dns import recvall
 
 logger = logging.getLogger(__name__)
 
+# requests of UDP servers are handled by fixed threads
+REQUEST_WORKERS = 32
+# TCP client may hold worker until TCP_TIMEOUT, TCP servers use own threads
+TCP_WORKERS = 8
+# requests waiting for worker, drop the oldest one when it is full
+REQUEST_BACKLOG = 1024
+# seconds, client has given up the request waiting so long
+REQUEST_STALE = 2
+# seconds to wait for TCP client, do not hold worker by idle connection
+TCP_TIMEOUT = 5
+
+
+def is_allowed_host(client_ip):
+    if client_ip in globalvars.allowed_ips:
+        return True
+    try:
+        ip = struct.unpack('!I', socket.inet_aton(client_ip))[0]
+    except OSError:
+        # IPv6 client
+        return client_ip in globalvars.allowed_hosts
+    ranges = globalvars.allowed_ranges
+    index = bisect_right(ranges, (ip, 0xFFFFFFFF)) - 1
+    return index >= 0 and ip <= ranges[index][1]
+
+
+class RequestPool(object):
+    """ fixed worker threads with backlog of requests """
+    def __init__(self, name, workers, backlog=REQUEST_BACKLOG):
+        self.name = name
+        self.size = workers
+        # [(enqueue time, server, request, client address)]
+        self.queue = queue.Queue(backlog)
+        self.workers = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ start in server thread, after worker processes are forked """
+        with self._lock:
+            if self.workers:
+                return
+            for index in range(self.size):
+                t = threading.Thread(
+                    target=self.worker,
+                    name='%s-request-%s' % (self.name, index),
+                )
+                t.daemon = True
+                t.start()
+                self.workers.append(t)
+
+    def worker(self):
+        while True:
+            enqueue_time, server, request, client_address = self.queue.get()
+            if time.monotonic() - enqueue_time > REQUEST_STALE:
+                logger.debug('Drop stale request from %s', client_address[0])
+                server.shutdown_request(request)
+                continue
+            server.process_request_thread(request, client_address)
+
+    def put(self, server, request, client_address):
+        item = (time.monotonic(), server, request, client_address)
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            # backlog is full, drop the oldest request
+            try:
+                _, old_server, old_request, old_address = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            logger.debug('Drop request from %s, backlog is full', old_address[0])
+            old_server.shutdown_request(old_request)
+
+
+_udp_pool = RequestPool('udp', REQUEST_WORKERS)
+_tcp_pool = RequestPool('tcp', TCP_WORKERS)
+
+
+class PoolMixIn(object):
+    """ handle request in worker pool instead of new thread """
+    # RequestPool shared by servers of same class
+    request_pool = None
+
+    def process_request(self, request, client_address):
+        pool = self.request_pool
+        if not pool.workers:
+            pool.start()
+        pool.put(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class ThreadingTCPServer(PoolMixIn, socketserver.TCPServer):
+    request_pool = _tcp_pool
 
-class ThreadingTCPServer(socketserver.ThreadingTCPServer):
     def __init__(self, server_address, RequestHandlerClass):
         ip = server_address[0]
         if ':' in ip:
@@ -23,13 +128,22 @@ class ThreadingTCPServer(socketserver.ThreadingTCPServer):
         super(ThreadingTCPServer, self).__init__(server_address, RequestHandlerClass)
 
 
-class ThreadingUDPServer(socketserver.ThreadingUDPServer):
-    def __init__(self, server_address, RequestHandlerClass):
+class ThreadingUDPServer(PoolMixIn, socketserver.UDPServer):
+    request_pool = _udp_pool
+
+    def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
         ip = server_address[0]
         if ':' in ip:
             self.address_family = socket.AF_INET6
+        # several processes bind same port, kernel distributes datagrams
+        self.reuse_port = reuse_port
         super(ThreadingUDPServer, self).__init__(server_address, RequestHandlerClass)
 
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super(ThreadingUDPServer, self).server_bind()
+
 
 class BaseRequestHandler(socketserver.BaseRequestHandler):
 
@@ -40,17 +154,16 @@ class BaseRequestHandler(socketserver.BaseRequestHandler):
         raise NotImplementedError
 
     def handle(self):
-        logger.debug('%s REQUEST %s' % ('=' * 35, '=' * 36))
-        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
         client_ip = self.client_address[0]
         client_port = self.client_address[1]
-        logger.warn("\n%s request %s (%s %s):" % (
-            self.__class__.__name__[:3],
-            now,
-            client_ip, client_port,
-        ))
-        if client_ip not in globalvars.allowed_hosts:
-            logger.warn('\t*** Not allowed host: %s ***' % client_ip)
+        logger.debug('%s REQUEST %s', '=' * 35, '=' * 36)
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+        logger.warning(
+            "\n%s request %s (%s %s):",
+            self.__class__.__name__[:3], now, client_ip, client_port,
+        )
+        if not is_allowed_host(client_ip):
+            logger.warning('\t*** Not allowed host: %s ***', client_ip)
             return
         try:
             data = self.get_data()
@@ -63,18 +176,17 @@ class BaseRequestHandler(socketserver.BaseRequestHandler):
 class TCPRequestHandler(BaseRequestHandler):
 
     def get_data(self):
-        data = self.request.recv(8192)
-        sz = int(binascii.b2a_hex(data[:2]), 16)
-        if sz < len(data) - 2:
-            raise Exception("Wrong size of TCP packet")
-        elif sz > len(data) - 2:
-            raise Exception("Too big TCP packet")
-        logger.debug('%s %s' % (len(data), binascii.b2a_hex(data[2:])))
-        return data[2:]
+        self.request.settimeout(TCP_TIMEOUT)
+        sz = struct.unpack('!H', recvall(self.request, 2))[0]
+        data = recvall(self.request, sz)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s %s', len(data), data.hex())
+        return data
 
     def send_data(self, data):
-        sz = bytes(binascii.a2b_hex(hex(len(data))[2:].zfill(4)))
-        logger.debug('%s %s' % (len(data), binascii.b2a_hex(data)))
+        sz = struct.pack('!H', len(data))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s %s', len(data), data.hex())
         return self.request.sendall(sz + data)
 
 
@@ -82,9 +194,11 @@ class UDPRequestHandler(BaseRequestHandler):
 
     def get_data(self):
         data = self.request[0]
-        logger.debug('%s %s' % (len(data), binascii.b2a_hex(data)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s %s', len(data), data.hex())
         return data
 
     def send_data(self, data):
-        logger.debug('%s %s' % (len(data), binascii.b2a_hex(data)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s %s', len(data), data.hex())
         return self.request[1].sendto(data, self.client_address)